@@ -0,0 +1,217 @@
+import copy
+import json
+import os
+import time
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+import psutil
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp']
+
+AUTOTUNE_FILENAME = 'autotune.json'
+
+
+class ProbeImageDataset(Dataset):
+    """
+    Minimal stand-in for the ultralytics training dataset: decode, letterbox
+    to img_size and convert to a CHW tensor. Cycles over the images so short
+    datasets still fill the probe.
+    """
+
+    def __init__(self, image_paths, img_size, length):
+        self.image_paths = image_paths
+        self.img_size = img_size
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, idx):
+        img = cv2.imread(str(self.image_paths[idx % len(self.image_paths)]))
+        if img is None:
+            img = np.zeros((self.img_size, self.img_size, 3), dtype=np.uint8)
+        h, w = img.shape[:2]
+        scale = self.img_size / max(h, w)
+        img = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_LINEAR)
+        h, w = img.shape[:2]
+        img = cv2.copyMakeBorder(img, 0, self.img_size - h, 0, self.img_size - w,
+                                 cv2.BORDER_CONSTANT, value=(114, 114, 114))
+        return torch.from_numpy(img.transpose(2, 0, 1).copy())
+
+
+def probe_loader(image_paths, img_size, batch_size, workers, batches=4):
+    """
+    Measure dataloader throughput in images/sec (worker startup excluded)
+    and the extra memory used by worker processes in bytes.
+    """
+    dataset = ProbeImageDataset(image_paths, img_size, batch_size * (batches + 1))
+    loader = DataLoader(dataset, batch_size=batch_size, num_workers=workers, shuffle=False)
+
+    process = psutil.Process()
+    worker_rss = 0
+    iterator = iter(loader)
+    next(iterator)  # Worker startup and first batch are not part of the steady state
+
+    start = time.perf_counter()
+    count = 0
+    for batch in iterator:
+        count += batch.shape[0]
+        worker_rss = max(worker_rss, sum(child.memory_info().rss for child in process.children(recursive=True)))
+    elapsed = time.perf_counter() - start
+    del iterator
+    return (count / elapsed if elapsed > 0 else 0.0), worker_rss
+
+
+def probe_compute(net, img_size, batch_size, threads, steps=2):
+    """
+    Measure forward/backward throughput in images/sec on CPU with `threads`
+    torch threads, and the peak process RSS observed during a step in bytes.
+    """
+    torch.set_num_threads(threads)
+    process = psutil.Process()
+    x = torch.rand(batch_size, 3, img_size, img_size)
+
+    def step():
+        outputs = net(x)
+        if isinstance(outputs, (list, tuple)):
+            loss = sum(o.float().mean() for o in outputs if isinstance(o, torch.Tensor))
+        else:
+            loss = outputs.float().mean()
+        rss = process.memory_info().rss  # Activations are still alive here
+        loss.backward()
+        net.zero_grad(set_to_none=True)
+        return rss
+
+    peak_rss = step()  # Warm-up (allocator, kernel selection)
+    start = time.perf_counter()
+    for _ in range(steps):
+        peak_rss = max(peak_rss, step())
+    elapsed = time.perf_counter() - start
+    return (batch_size * steps / elapsed if elapsed > 0 else 0.0), peak_rss
+
+
+def candidate_settings(cpu_count, batch_size):
+    """
+    Candidate batch sizes and torch thread counts. There is no worker
+    dimension: ultralytics forces workers=0 on CPU, so images are loaded in
+    the training process between steps.
+    """
+    batches = sorted({b for b in (4, 8, 16, 32, batch_size) if b > 0})
+    threads = sorted({max(1, cpu_count // 2), max(1, cpu_count - 1), cpu_count})
+    return batches, threads
+
+
+def pin_torch_threads(model, threads):
+    """
+    Make training use `threads` torch threads. Setting them before
+    model.train() has no effect: the trainer's select_device resets them on
+    CPU/MPS, so they are set from a callback that runs after it.
+    """
+    def on_pretrain_routine_start(trainer):
+        torch.set_num_threads(threads)
+
+    model.add_callback('on_pretrain_routine_start', on_pretrain_routine_start)
+
+
+def autotune_training(model, train_images_dir, img_size, output_dir, batch_size=16, memory_budget_gb=None):
+    """
+    Pick batch size and torch threads for CPU training.
+
+    Runs a short timed probe of in-process image loading (workers=0, which is
+    what ultralytics uses on CPU) and of forward/backward passes (per batch
+    size and thread count). Loading and compute run one after the other, so
+    the throughput of each combination is estimated from the sum of their
+    per-image times. Keeps the fastest combination whose estimated memory fits
+    the budget (default: 80% of the currently available RAM). The result is
+    written to output_dir/autotune.json.
+
+    Returns a dict with 'batch' and 'torch_threads' (apply the threads with
+    pin_torch_threads).
+    """
+    output_dir = Path(output_dir)
+    cpu_count = os.cpu_count() or 1
+
+    if memory_budget_gb:
+        memory_budget = memory_budget_gb * 1024 ** 3
+    else:
+        memory_budget = psutil.virtual_memory().available * 0.8
+
+    image_paths = sorted(p for p in Path(train_images_dir).iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+    if not image_paths:
+        print("Autotune: no training images found, keeping the given settings.", flush=True)
+        return None
+
+    batches, thread_options = candidate_settings(cpu_count, batch_size)
+    print(f"Autotune: probing batches {batches}, threads {thread_options} on {cpu_count} CPU cores...", flush=True)
+
+    # Probe a copy so BatchNorm statistics of the starting weights are untouched
+    net = copy.deepcopy(model.model).float().train()
+    for p in net.parameters():
+        p.requires_grad_(True)
+
+    original_threads = torch.get_num_threads()
+    loader_ips, _ = probe_loader(image_paths, img_size, min(batches[-1], 8), 0)
+    print(f"Autotune: in-process loading: {loader_ips:.1f} images/sec", flush=True)
+
+    compute_results = {}
+    for threads in thread_options:
+        for batch in batches:
+            try:
+                ips, rss = probe_compute(net, img_size, batch, threads)
+            except RuntimeError as e:
+                # Typically out of memory; larger batches will not fit either
+                print(f"Autotune: batch={batch} threads={threads} failed: {e}", flush=True)
+                break
+            compute_results[(batch, threads)] = (ips, rss)
+            print(f"Autotune: batch={batch} threads={threads}: {ips:.1f} images/sec "
+                  f"(peak RSS {rss / 1024 ** 3:.2f} GB)", flush=True)
+            if rss > memory_budget:
+                break
+
+    torch.set_num_threads(original_threads)
+    del net
+
+    candidates = []
+    for (batch, threads), (compute_ips, compute_rss) in compute_results.items():
+        if loader_ips > 0 and compute_ips > 0:
+            images_per_sec = 1 / (1 / loader_ips + 1 / compute_ips)
+        else:
+            images_per_sec = 0.0
+        candidates.append({
+            'batch': batch,
+            'torch_threads': threads,
+            'images_per_sec': round(images_per_sec, 2),
+            'loader_images_per_sec': round(loader_ips, 2),
+            'compute_images_per_sec': round(compute_ips, 2),
+            'estimated_memory_gb': round(compute_rss / 1024 ** 3, 3),
+            'fits_budget': compute_rss <= memory_budget
+        })
+
+    fitting = [c for c in candidates if c['fits_budget']]
+    if not fitting:
+        print("Autotune: no candidate fits the memory budget, keeping the given settings.", flush=True)
+        return None
+
+    # Fastest first; on ties prefer the larger batch (fewer optimizer steps)
+    best = max(fitting, key=lambda c: (c['images_per_sec'], c['batch']))
+    print(f"Autotune: selected batch={best['batch']}, "
+          f"torch threads={best['torch_threads']} ({best['images_per_sec']:.1f} images/sec)", flush=True)
+
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'cpu_count': cpu_count,
+        'img_size': img_size,
+        'memory_budget_gb': round(memory_budget / 1024 ** 3, 3),
+        'selected': best,
+        'candidates': sorted(candidates, key=lambda c: -c['images_per_sec'])
+    }
+    output_dir.mkdir(parents=True, exist_ok=True)
+    with open(output_dir / AUTOTUNE_FILENAME, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    return best
@@ -0,0 +1,441 @@
+import argparse
+import csv
+import gc
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import psutil
+from ultralytics import YOLO
+
+from model_export import BACKEND_PREFERENCE, select_backend
+from model_registry import DEFAULT_HISTORY_DIR, ModelRegistry, resolve_model_spec
+from predict import iter_decoded_batches, resolve_sources
+
+# COCO style IoU thresholds for mAP50-95
+IOU_THRESHOLDS = np.linspace(0.5, 0.95, 10)
+
+# Confidence used for the accuracy pass; mAP needs the full precision/recall curve
+EVAL_CONF = 0.001
+
+DEFAULT_BATCH_SIZES = [1, 4, 8]
+
+# Threads decoding test images ahead of inference
+DECODE_WORKERS = 2
+
+
+class MemorySampler:
+    """
+    Samples the RSS of this process in a background thread and keeps the peak.
+    Used as a context manager around everything done with one model.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.process = psutil.Process()
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        self.baseline = self.process.memory_info().rss
+        self.peak = self.baseline
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+
+def find_label(image_path):
+    """
+    YOLO label for an image in a test folder: FOLDER/labels/STEM.txt or FOLDER/STEM.txt.
+    """
+    image_path = Path(image_path)
+    for candidate in [image_path.parent / 'labels' / f"{image_path.stem}.txt",
+                      image_path.with_suffix('.txt')]:
+        if candidate.exists():
+            return candidate
+    return None
+
+
+def load_labels(label_path):
+    """
+    Read a YOLO label file into (classes, normalized xyxy boxes) arrays.
+    """
+    classes, boxes = [], []
+    with open(label_path, 'r') as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) < 5:
+                continue
+            cls, xc, yc, w, h = int(float(parts[0])), *map(float, parts[1:5])
+            classes.append(cls)
+            boxes.append([xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2])
+    return np.array(classes, dtype=np.int64), np.array(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def iou_matrix(a, b):
+    """
+    Pairwise IoU of xyxy boxes: (N, 4) x (M, 4) -> (N, M).
+    """
+    tl = np.maximum(a[:, None, :2], b[None, :, :2])
+    br = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(br - tl, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def match_predictions(pred_classes, pred_boxes, pred_scores, gt_classes, gt_boxes):
+    """
+    Greedy matching (highest confidence first) of predictions to ground truth of
+    the same class, once per IoU threshold.
+    Returns a (num_predictions, len(IOU_THRESHOLDS)) boolean true-positive matrix.
+    """
+    tp = np.zeros((len(pred_classes), len(IOU_THRESHOLDS)), dtype=bool)
+    if not len(pred_classes) or not len(gt_classes):
+        return tp
+
+    iou = iou_matrix(pred_boxes, gt_boxes)
+    iou[pred_classes[:, None] != gt_classes[None, :]] = 0.0
+    order = np.argsort(-pred_scores)
+    for t, threshold in enumerate(IOU_THRESHOLDS):
+        used = np.zeros(len(gt_classes), dtype=bool)
+        for i in order:
+            candidates = np.where(~used & (iou[i] >= threshold))[0]
+            if len(candidates):
+                j = candidates[np.argmax(iou[i, candidates])]
+                used[j] = True
+                tp[i, t] = True
+    return tp
+
+
+def average_precision(tp, scores, num_gt):
+    """
+    101-point interpolated AP for each IoU threshold column of tp.
+    """
+    if num_gt == 0 or not len(scores):
+        return np.zeros(tp.shape[1])
+    order = np.argsort(-scores)
+    tp = tp[order]
+    tp_cum = np.cumsum(tp, axis=0)
+    fp_cum = np.cumsum(~tp, axis=0)
+    recall = tp_cum / num_gt
+    precision = tp_cum / (tp_cum + fp_cum)
+
+    points = np.linspace(0, 1, 101)
+    ap = np.zeros(tp.shape[1])
+    for t in range(tp.shape[1]):
+        # Precision envelope, then sample it at fixed recall levels
+        envelope = np.flip(np.maximum.accumulate(np.flip(precision[:, t])))
+        indices = np.searchsorted(recall[:, t], points, side='left')
+        sampled = np.array([envelope[i] if i < len(envelope) else 0.0 for i in indices])
+        ap[t] = sampled.mean()
+    return ap
+
+
+def detection_metrics(records, names, conf_thres):
+    """
+    Precision/recall at conf_thres (IoU 0.5) and mAP50 / mAP50-95 over all
+    classes present in the labels. records holds one dict per labeled image
+    with pred_* and gt_* arrays.
+    """
+    pred_classes = np.concatenate([r['pred_classes'] for r in records])
+    pred_scores = np.concatenate([r['pred_scores'] for r in records])
+    tp = np.concatenate([r['tp'] for r in records])
+    gt_classes = np.concatenate([r['gt_classes'] for r in records])
+
+    per_class = {}
+    for cls in np.unique(gt_classes):
+        mask = pred_classes == cls
+        ap = average_precision(tp[mask], pred_scores[mask], int((gt_classes == cls).sum()))
+        per_class[names.get(int(cls), str(cls))] = {'mAP50': round(float(ap[0]), 4), 'mAP50-95': round(float(ap.mean()), 4)}
+
+    kept = pred_scores >= conf_thres
+    true_positives = int(tp[kept, 0].sum())
+    predicted = int(kept.sum())
+    return {
+        'labeled_images': len(records),
+        'instances': int(len(gt_classes)),
+        'precision': round(true_positives / predicted, 4) if predicted else 0.0,
+        'recall': round(true_positives / len(gt_classes), 4) if len(gt_classes) else 0.0,
+        'mAP50': round(float(np.mean([c['mAP50'] for c in per_class.values()])), 4) if per_class else 0.0,
+        'mAP50-95': round(float(np.mean([c['mAP50-95'] for c in per_class.values()])), 4) if per_class else 0.0,
+        'per_class': per_class
+    }
+
+
+def iter_images(image_paths, batch_size=1):
+    """
+    Stream the test images as lists of (path, image), batch_size at a time.
+    Images are decoded a few batches ahead on a thread pool (see
+    predict.iter_decoded_batches), so memory does not grow with the test set
+    and decoding is not part of the timings. Undecodable images are skipped.
+    """
+    for batch in iter_decoded_batches(image_paths, batch_size, DECODE_WORKERS):
+        batch = [(path, image) for path, image in batch if image is not None]
+        if batch:
+            yield batch
+
+
+def evaluate_accuracy(model, image_paths, conf_thres):
+    """
+    Run the accuracy pass over the labeled images. Returns None if no image has a label.
+    """
+    labeled = [path for path in image_paths if find_label(path) is not None]
+    records = []
+    for [(image_path, image)] in iter_images(labeled):
+        gt_classes, gt_boxes = load_labels(find_label(image_path))
+        boxes = model(image, conf=EVAL_CONF, verbose=False)[0].boxes
+        pred_classes = boxes.cls.cpu().numpy().astype(np.int64)
+        pred_scores = boxes.conf.cpu().numpy().astype(np.float64)
+        pred_boxes = boxes.xyxyn.cpu().numpy().astype(np.float64)
+        records.append({
+            'pred_classes': pred_classes,
+            'pred_scores': pred_scores,
+            'tp': match_predictions(pred_classes, pred_boxes, pred_scores, gt_classes, gt_boxes),
+            'gt_classes': gt_classes
+        })
+    if not records:
+        return None
+    return detection_metrics(records, dict(model.names), conf_thres)
+
+
+def measure_latency(model, image_paths, conf_thres, warmup=3):
+    """
+    Single-image latency (decode excluded, pre/postprocessing included) in milliseconds.
+    Returns (percentiles, number of images measured).
+    """
+    timings = []
+    for index, [(_, image)] in enumerate(iter_images(image_paths)):
+        if index < warmup:
+            model(image, conf=conf_thres, verbose=False)
+        start = time.perf_counter()
+        model(image, conf=conf_thres, verbose=False)
+        timings.append((time.perf_counter() - start) * 1000)
+    if not timings:
+        raise ValueError("None of the test images could be decoded")
+    timings = np.array(timings)
+    return {
+        'p50_ms': round(float(np.percentile(timings, 50)), 2),
+        'p95_ms': round(float(np.percentile(timings, 95)), 2),
+        'p99_ms': round(float(np.percentile(timings, 99)), 2),
+        'mean_ms': round(float(timings.mean()), 2)
+    }, len(timings)
+
+
+def measure_throughput(model, image_paths, conf_thres, batch_size, min_images=32):
+    """
+    Images/sec when feeding mini-batches of batch_size (decode excluded). The
+    test set is streamed again until at least min_images were processed so
+    small folders still give a stable number.
+    """
+    processed = 0
+    elapsed = 0.0
+    warmed_up = False
+    while processed < min_images:
+        before = processed
+        for batch in iter_images(image_paths, batch_size):
+            frames = [image for _, image in batch]
+            if not warmed_up:
+                model(frames, conf=conf_thres, verbose=False)  # Warm-up for this batch shape
+                warmed_up = True
+            start = time.perf_counter()
+            model(frames, conf=conf_thres, verbose=False)
+            elapsed += time.perf_counter() - start
+            processed += len(frames)
+        if processed == before:
+            break
+    return round(processed / elapsed, 2) if elapsed > 0 else None
+
+
+def evaluate_model(model_path, image_paths, conf_thres=0.25, batch_sizes=DEFAULT_BATCH_SIZES, backend='auto'):
+    """
+    Load one model and measure accuracy (if labels exist), latency, throughput,
+    load time and peak memory on the test images, which are streamed from disk
+    for every pass so the memory numbers reflect the model, not the test set.
+    """
+    weights, backend_name, export_info = select_backend(model_path, backend)
+    if backend_name != 'pt' and not export_info.get('dynamic', False):
+        # Exports with a fixed batch dimension take one image at a time
+        batch_sizes = [1]
+
+    result = {
+        'model': str(model_path),
+        'weights': weights,
+        'backend': backend_name
+    }
+
+    with MemorySampler() as memory:
+        start = time.perf_counter()
+        model = YOLO(weights) if backend_name == 'pt' else YOLO(weights, task='detect')
+        result['load_seconds'] = round(time.perf_counter() - start, 3)
+
+        # The first call sets up the predictor and backend session
+        [(_, first_image)] = next(iter_images(image_paths), [(None, None)])
+        if first_image is None:
+            raise ValueError("None of the test images could be decoded")
+        start = time.perf_counter()
+        model(first_image, conf=conf_thres, verbose=False)
+        result['first_inference_seconds'] = round(time.perf_counter() - start, 3)
+        del first_image
+
+        result['latency'], result['images'] = measure_latency(model, image_paths, conf_thres)
+        result['throughput'] = {str(b): measure_throughput(model, image_paths, conf_thres, b) for b in batch_sizes}
+        result['accuracy'] = evaluate_accuracy(model, image_paths, conf_thres)
+
+    result['peak_rss_mb'] = round(memory.peak / 1024 ** 2, 1)
+    result['peak_rss_delta_mb'] = round((memory.peak - memory.baseline) / 1024 ** 2, 1)
+
+    del model
+    gc.collect()
+    return result
+
+
+def collect_models(model_specs, history_dir, class_name=None):
+    """
+    Models to evaluate as a list of (path, registry record or None).
+    Without --model every registered model in models_history is used,
+    ordered by class and learning percent so three-step stages line up.
+    """
+    if model_specs:
+        models = []
+        for spec in model_specs:
+            path = resolve_model_spec(spec, history_dir)
+            models.append((path, None))
+        return models
+
+    registry = ModelRegistry(history_dir)
+    records = sorted(registry.find(class_name), key=lambda r: (r['class_name'], r['percent'], r['created']))
+    return [(str(registry.path_of(r)), r) for r in records]
+
+
+def flatten_result(result):
+    """
+    One CSV row per model.
+    """
+    row = {
+        'model': result['model'],
+        'class_name': result.get('class_name'),
+        'percent': result.get('percent'),
+        'backend': result.get('backend'),
+        'images': result.get('images'),
+        'load_seconds': result.get('load_seconds'),
+        'first_inference_seconds': result.get('first_inference_seconds'),
+        'peak_rss_mb': result.get('peak_rss_mb'),
+        'peak_rss_delta_mb': result.get('peak_rss_delta_mb'),
+        'error': result.get('error')
+    }
+    for key, value in (result.get('latency') or {}).items():
+        row[f'latency_{key}'] = value
+    for batch, value in (result.get('throughput') or {}).items():
+        row[f'images_per_sec_b{batch}'] = value
+    accuracy = result.get('accuracy') or {}
+    for key in ['labeled_images', 'instances', 'precision', 'recall', 'mAP50', 'mAP50-95']:
+        row[key] = accuracy.get(key)
+    return row
+
+
+def write_report(results, report_path, settings):
+    report_path = Path(report_path)
+    report_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(report_path, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'settings': settings, 'models': results}, f, indent=2)
+
+    rows = [flatten_result(r) for r in results]
+    fieldnames = []
+    for row in rows:
+        fieldnames.extend(k for k in row if k not in fieldnames)
+    csv_path = report_path.with_suffix('.csv')
+    with open(csv_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames)
+        writer.writeheader()
+        writer.writerows(rows)
+    return report_path, csv_path
+
+
+def evaluate(model_specs, source, history_dir=DEFAULT_HISTORY_DIR, class_name=None, conf_thres=0.25,
+             batch_sizes=DEFAULT_BATCH_SIZES, backend='auto', report_path=None):
+    image_paths = [path for path in resolve_sources(source) if os.path.isfile(path)]
+    if not image_paths:
+        print(f"Error: No images found for source {source}", file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        models = collect_models(model_specs, history_dir, class_name)
+    except FileNotFoundError as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        sys.exit(1)
+    if not models:
+        print(f"Error: No models to evaluate in {history_dir}", file=sys.stderr)
+        sys.exit(1)
+
+    labeled = sum(1 for path in image_paths if find_label(path) is not None)
+    print(f"Evaluating {len(models)} model(s) on {len(image_paths)} images ({labeled} labeled)...", flush=True)
+
+    results = []
+    for index, (path, record) in enumerate(models, 1):
+        print(f"[{index}/{len(models)}] {os.path.basename(path)}", flush=True)
+        try:
+            result = evaluate_model(path, image_paths, conf_thres, batch_sizes, backend)
+        except Exception as e:
+            print(f"Error evaluating {path}: {e}", flush=True)
+            result = {'model': path, 'error': str(e)}
+        if record:
+            result.update({'class_name': record['class_name'], 'percent': record['percent']})
+        results.append(result)
+
+        if 'error' not in result:
+            if result['images'] < len(image_paths):
+                print(f"  {len(image_paths) - result['images']} image(s) could not be decoded and were skipped", flush=True)
+            accuracy = result['accuracy']
+            throughput = ', '.join(f"b{b}: {ips} img/s" for b, ips in result['throughput'].items())
+            print(f"  load {result['load_seconds']}s, latency p50/p95/p99 "
+                  f"{result['latency']['p50_ms']}/{result['latency']['p95_ms']}/{result['latency']['p99_ms']} ms, "
+                  f"{throughput}, peak RSS {result['peak_rss_mb']} MB", flush=True)
+            if accuracy:
+                print(f"  P {accuracy['precision']}, R {accuracy['recall']}, "
+                      f"mAP50 {accuracy['mAP50']}, mAP50-95 {accuracy['mAP50-95']}", flush=True)
+
+    if report_path is None:
+        source_dir = source if os.path.isdir(source) else os.path.dirname(os.path.abspath(image_paths[0]))
+        report_path = Path(source_dir) / 'evaluation' / f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+    settings = {'source': source, 'conf': conf_thres, 'batch_sizes': batch_sizes, 'backend': backend}
+    json_path, csv_path = write_report(results, report_path, settings)
+    print(f"REPORT_PATH:{json_path}", flush=True)
+    print(f"REPORT_CSV:{csv_path}", flush=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark trained models on a test folder (e.g. FOR_TESTS)")
+    parser.add_argument("--model", action="append",
+                        help="Model path or registry:CLASS[:PERCENT]; repeatable. Default: every model in models_history")
+    parser.add_argument("--source", required=True, help="Test images: directory, glob pattern, .txt list or comma separated paths")
+    parser.add_argument("--class-name", help="Only evaluate registered models of this class")
+    parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold for latency/throughput and precision/recall")
+    parser.add_argument("--batch-sizes", default=",".join(map(str, DEFAULT_BATCH_SIZES)),
+                        help="Comma separated batch sizes for the throughput measurement")
+    parser.add_argument("--backend", choices=['auto'] + BACKEND_PREFERENCE, default="auto", help="Inference backend")
+    parser.add_argument("--history", default=str(DEFAULT_HISTORY_DIR), help="models_history folder")
+    parser.add_argument("--report", help="Report path (.json; a .csv is written next to it)")
+    args = parser.parse_args()
+
+    batch_sizes = sorted({int(b) for b in args.batch_sizes.split(',') if b.strip() and int(b) > 0}) or [1]
+    evaluate(args.model, args.source, args.history, args.class_name, args.conf, batch_sizes, args.backend, args.report)
@@ -0,0 +1,60 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+
+def hash_file(path, algorithm='sha1', chunk_size=1024 * 1024):
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FileHashIndex:
+    """
+    sha1 content hashes memoized by absolute path and (mtime, size) signature,
+    persisted as JSON ({path: {"sig": ..., "sha1": ...}}), so unchanged files
+    are not re-read on later runs. One index can be shared by the dataset
+    steps (preflight, resized image cache) so each file is hashed once.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.entries = {}
+        self.lock = threading.Lock()
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.entries = json.load(f)
+            except (OSError, ValueError):
+                self.entries = {}
+
+    def known(self, file_path, sig):
+        """
+        The memoized hash, or None if the file is new or changed since.
+        """
+        with self.lock:
+            entry = self.entries.get(str(Path(file_path).absolute()))
+        return entry['sha1'] if entry and entry['sig'] == sig else None
+
+    def record(self, file_path, sig, sha1):
+        with self.lock:
+            self.entries[str(Path(file_path).absolute())] = {'sig': sig, 'sha1': sha1}
+
+    def get(self, file_path, sig):
+        digest = self.known(file_path, sig)
+        if digest is None:
+            digest = hash_file(file_path)
+            self.record(file_path, sig, digest)
+        return digest
+
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self.lock:
+            tmp_path = self.path.with_suffix('.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self.entries, f)
+            os.replace(tmp_path, self.path)
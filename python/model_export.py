@@ -0,0 +1,234 @@
+import importlib.util
+import json
+import shutil
+from pathlib import Path
+
+EXPORT_FORMATS = ['onnx', 'openvino', 'torchscript']
+EXPORT_PRECISIONS = ['fp32', 'fp16', 'int8']
+
+# Inference backends in order of preference on CPU
+BACKEND_PREFERENCE = ['openvino', 'onnx', 'torchscript', 'pt']
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp']
+
+
+def exports_manifest_path(weights_path):
+    """
+    Sidecar describing the exports of a .pt file: MODEL.pt -> MODEL.exports.json
+    """
+    weights_path = Path(weights_path)
+    return weights_path.with_name(weights_path.stem + '.exports.json')
+
+
+def load_exports(weights_path):
+    path = exports_manifest_path(weights_path)
+    if not path.exists():
+        return {}
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def backend_available(backend):
+    if backend == 'onnx':
+        return importlib.util.find_spec('onnxruntime') is not None
+    if backend == 'openvino':
+        return importlib.util.find_spec('openvino') is not None
+    return True
+
+
+def select_backend(weights_path, backend='auto'):
+    """
+    Pick the weights to load for inference.
+
+    backend='auto' uses the first export listed in the .exports.json sidecar
+    (in BACKEND_PREFERENCE order) whose runtime is installed and which passed
+    its parity check, and falls back to the .pt file.
+    Returns (path, backend name, export info dict).
+    """
+    weights_path = Path(weights_path)
+    if weights_path.suffix != '.pt':
+        return str(weights_path), weights_path.suffix.lstrip('.') or 'openvino', {}
+
+    exports = load_exports(weights_path)
+    candidates = BACKEND_PREFERENCE if backend == 'auto' else [backend]
+    for name in candidates:
+        if name == 'pt':
+            return str(weights_path), 'pt', {}
+        info = exports.get(name)
+        if not info or not backend_available(name):
+            continue
+        if backend == 'auto' and not info.get('parity', {}).get('passed', False):
+            continue
+        path = weights_path.parent / info['file']
+        if path.exists():
+            return str(path), name, info
+
+    if backend not in ('auto', 'pt'):
+        raise FileNotFoundError(f"No usable {backend} export found for {weights_path}")
+    return str(weights_path), 'pt', {}
+
+
+def find_sample_images(raw_path, limit=20):
+    """
+    Images for the parity check: FOR_TESTS in the raw folder or its parent
+    (three-step stage folders live inside the class folder).
+    """
+    raw_path = Path(raw_path)
+    for folder in [raw_path / 'FOR_TESTS', raw_path.parent / 'FOR_TESTS']:
+        if folder.is_dir():
+            images = sorted(p for p in folder.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+            if images:
+                return images[:limit]
+    return []
+
+
+def box_iou(a, b):
+    """
+    IoU of two normalized (x_center, y_center, width, height) boxes.
+    """
+    ax1, ay1 = a[0] - a[2] / 2, a[1] - a[3] / 2
+    ax2, ay2 = a[0] + a[2] / 2, a[1] + a[3] / 2
+    bx1, by1 = b[0] - b[2] / 2, b[1] - b[3] / 2
+    bx2, by2 = b[0] + b[2] / 2, b[1] + b[3] / 2
+    inter = max(0.0, min(ax2, bx2) - max(ax1, bx1)) * max(0.0, min(ay2, by2) - max(ay1, by1))
+    union = a[2] * a[3] + b[2] * b[3] - inter
+    return inter / union if union > 0 else 0.0
+
+
+def result_boxes(result):
+    return [
+        (int(box.cls[0]), float(box.conf[0]), box.xywhn[0].tolist())
+        for box in result.boxes
+    ]
+
+
+def check_parity(reference_model, exported_model, images, img_size, conf=0.25, iou_tol=0.9, conf_tol=0.05):
+    """
+    Compare detections of the exported model against the .pt model.
+    Every reference box must be matched by an exported box of the same class
+    with IoU >= iou_tol and confidence within conf_tol, and box counts must agree.
+    Returns a summary dict with 'passed'.
+    """
+    matched_images = 0
+    worst_iou = 1.0
+    worst_conf_delta = 0.0
+
+    for image in images:
+        expected = result_boxes(reference_model(str(image), conf=conf, imgsz=img_size, verbose=False)[0])
+        actual = result_boxes(exported_model(str(image), conf=conf, imgsz=img_size, verbose=False)[0])
+
+        ok = len(expected) == len(actual)
+        unused = list(actual)
+        for cls, score, xywh in expected:
+            best = None
+            for candidate in unused:
+                if candidate[0] != cls:
+                    continue
+                iou = box_iou(xywh, candidate[2])
+                if best is None or iou > best[0]:
+                    best = (iou, candidate)
+            if best is None:
+                ok = False
+                continue
+            iou, candidate = best
+            unused.remove(candidate)
+            worst_iou = min(worst_iou, iou)
+            worst_conf_delta = max(worst_conf_delta, abs(score - candidate[1]))
+            if iou < iou_tol or abs(score - candidate[1]) > conf_tol:
+                ok = False
+
+        if ok:
+            matched_images += 1
+
+    return {
+        'passed': bool(images) and matched_images == len(images),
+        'images': len(images),
+        'matched_images': matched_images,
+        'worst_iou': round(worst_iou, 4),
+        'worst_conf_delta': round(worst_conf_delta, 4),
+        'iou_tolerance': iou_tol,
+        'conf_tolerance': conf_tol
+    }
+
+
+def quantize_onnx_int8(onnx_path):
+    """
+    Dynamic INT8 weight quantization with onnxruntime; replaces onnx_path in place.
+    """
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    onnx_path = Path(onnx_path)
+    quantized = onnx_path.with_name(onnx_path.stem + '.int8.onnx')
+    quantize_dynamic(str(onnx_path), str(quantized), weight_type=QuantType.QUInt8)
+    quantized.replace(onnx_path)
+
+
+def export_model(model_cls, weights_path, target_path, formats, img_size, data_yaml=None,
+                 dynamic=False, precision='fp32', sample_images=None):
+    """
+    Export weights_path to CPU inference formats and place the results next to
+    target_path (the models_history copy): MODEL.onnx, MODEL_openvino_model/,
+    MODEL.torchscript, plus a MODEL.exports.json sidecar used by predict.py.
+
+    Each export is checked against the .pt model on sample_images (see
+    check_parity); exports that fail are kept but not chosen automatically.
+    model_cls is the ultralytics YOLO class.
+    Returns the sidecar contents.
+    """
+    target_path = Path(target_path)
+    exports = load_exports(target_path)
+    reference = model_cls(str(weights_path))
+
+    for fmt in formats:
+        print(f"Exporting to {fmt} ({precision}{', dynamic batch' if dynamic else ''})...", flush=True)
+        export_kwargs = {'format': fmt, 'imgsz': img_size}
+        if fmt == 'onnx':
+            export_kwargs['dynamic'] = dynamic
+        if precision == 'fp16':
+            export_kwargs['half'] = True
+        elif precision == 'int8' and fmt == 'openvino':
+            # OpenVINO calibrates on the training data
+            export_kwargs['int8'] = True
+            if data_yaml:
+                export_kwargs['data'] = str(data_yaml)
+
+        try:
+            exported = Path(model_cls(str(weights_path)).export(**export_kwargs))
+            if precision == 'int8' and fmt == 'onnx':
+                quantize_onnx_int8(exported)
+        except Exception as e:
+            print(f"Export to {fmt} failed: {e}", flush=True)
+            continue
+
+        if fmt == 'openvino':
+            destination = target_path.with_name(target_path.stem + '_openvino_model')
+        else:
+            destination = target_path.with_suffix(exported.suffix)
+        if destination.is_dir():
+            shutil.rmtree(destination)
+        elif destination.exists():
+            destination.unlink()
+        shutil.move(str(exported), str(destination))
+
+        info = {'file': destination.name, 'dynamic': dynamic if fmt == 'onnx' else False, 'precision': precision}
+        if sample_images and backend_available(fmt):
+            try:
+                info['parity'] = check_parity(reference, model_cls(str(destination), task='detect'), sample_images, img_size)
+            except Exception as e:
+                info['parity'] = {'passed': False, 'error': str(e)}
+            parity = info['parity']
+            print(f"Parity check ({fmt}): {parity.get('matched_images', 0)}/{parity.get('images', 0)} images match"
+                  f"{'' if parity['passed'] else ' - export will not be selected automatically'}", flush=True)
+        else:
+            info['parity'] = {'passed': False, 'error': 'no sample images or runtime not installed'}
+            print(f"Parity check ({fmt}) skipped: no FOR_TESTS images or runtime not installed", flush=True)
+
+        exports[fmt] = info
+        print(f"Exported model saved to: {destination}", flush=True)
+
+    with open(exports_manifest_path(target_path), 'w') as f:
+        json.dump(exports, f, indent=2)
+    return exports
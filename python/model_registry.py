@@ -0,0 +1,231 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+from datetime import datetime
+from pathlib import Path
+
+from file_hashes import hash_file
+
+REGISTRY_NAME = 'registry.json'
+
+# Content-addressed weight blobs; the named history files are hardlinks to these
+OBJECTS_DIR = '.objects'
+
+DEFAULT_METRIC = 'metrics/mAP50-95(B)'
+
+# CLASSNAME_LEARNINGPERCENT_YYYYMMDD_HHMMSS.pt
+HISTORY_NAME_PATTERN = re.compile(r'^(?P<class_name>.+)_(?P<percent>\d+)_(?P<date>\d{8})_(?P<time>\d{6})\.pt$')
+
+DEFAULT_HISTORY_DIR = Path(__file__).resolve().parent.parent / 'models' / 'models_history'
+
+
+def clean_class_name(class_name):
+    """
+    Class name as used in history filenames (remove spaces, path separators; max 30 chars).
+    """
+    return class_name.replace(' ', '_').replace('/', '_').replace('\\', '_')[:30]
+
+
+def hash_dataset(dataset_path):
+    """
+    Fingerprint of a formatted dataset, taken from the split manifest written by
+    split_dataset (file names, source signatures and split assignment).
+    Returns None if the dataset has no manifest.
+    """
+    manifest_path = Path(dataset_path) / '.split_manifest.json'
+    if not manifest_path.exists():
+        return None
+    with open(manifest_path, 'r') as f:
+        files = json.load(f).get('files', {})
+    digest = hashlib.sha256()
+    for name in sorted(files):
+        entry = files[name]
+        digest.update(json.dumps([name, entry.get('splits'), entry.get('image_sig'), entry.get('label_sig')]).encode())
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+class ModelRegistry:
+    """
+    Index of trained models in models_history.
+
+    Each record holds class name, learning percent, creation time, dataset
+    hash, final metrics, training time and the sha256 of the weights.
+    Weights are stored once per content hash under .objects/ and the human
+    readable CLASSNAME_PERCENT_TIMESTAMP.pt files are hardlinks to them, so
+    identical weights take no extra space.
+    """
+
+    def __init__(self, history_dir=DEFAULT_HISTORY_DIR):
+        self.history_dir = Path(history_dir)
+        self.path = self.history_dir / REGISTRY_NAME
+        self.records = []
+        self.load()
+
+    def load(self):
+        if self.path.exists():
+            try:
+                with open(self.path, 'r') as f:
+                    self.records = json.load(f).get('models', [])
+                return
+            except (OSError, ValueError):
+                self.records = []
+        # First use: index history files written before the registry existed
+        if self.history_dir.exists():
+            self.import_existing()
+
+    def save(self):
+        self.history_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'models': self.records}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+    def import_existing(self):
+        """
+        Add records for history files that follow the naming scheme but are not registered yet.
+        Metadata is limited to what the filename holds.
+        """
+        known = {record['file'] for record in self.records}
+        added = 0
+        for path in sorted(self.history_dir.glob('*.pt')):
+            match = HISTORY_NAME_PATTERN.match(path.name)
+            if not match or path.name in known:
+                continue
+            created = datetime.strptime(match['date'] + match['time'], '%Y%m%d%H%M%S')
+            self.records.append({
+                'file': path.name,
+                'sha256': hash_file(path, 'sha256'),
+                'class_name': match['class_name'],
+                'percent': int(match['percent']),
+                'created': created.isoformat(timespec='seconds'),
+                'dataset_hash': None,
+                'metrics': {},
+                'training_time': None
+            })
+            added += 1
+        if added:
+            self.save()
+        return added
+
+    def register(self, weights_path, name, class_name, percent, dataset_hash=None, metrics=None,
+                 training_time=None, **extra):
+        """
+        Store weights_path in the history under `name` and record its metadata.
+        Returns the new record.
+        """
+        weights_path = Path(weights_path)
+        digest = hash_file(weights_path, 'sha256')
+
+        objects_dir = self.history_dir / OBJECTS_DIR
+        objects_dir.mkdir(parents=True, exist_ok=True)
+        blob = objects_dir / f"{digest}.pt"
+        if not blob.exists():
+            tmp_blob = blob.with_suffix('.tmp')
+            shutil.copy2(weights_path, tmp_blob)
+            os.replace(tmp_blob, blob)
+
+        history_model = self.history_dir / name
+        if history_model.exists():
+            history_model.unlink()
+        link_or_copy(blob, history_model)
+
+        record = {
+            'file': name,
+            'sha256': digest,
+            'class_name': class_name,
+            'percent': percent,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'dataset_hash': dataset_hash,
+            'metrics': {k: float(v) for k, v in (metrics or {}).items()},
+            'training_time': training_time
+        }
+        record.update(extra)
+        self.records = [r for r in self.records if r['file'] != name]
+        self.records.append(record)
+        self.save()
+        return record
+
+    def path_of(self, record):
+        return self.history_dir / record['file']
+
+    def find(self, class_name=None, percent=None):
+        """
+        Registered models matching the filters, newest first.
+        Records whose history file was deleted by hand are skipped.
+        """
+        matches = [
+            r for r in self.records
+            if (class_name is None or clean_class_name(r['class_name']) == clean_class_name(class_name))
+            and (percent is None or r['percent'] == percent)
+            and self.path_of(r).exists()
+        ]
+        return sorted(matches, key=lambda r: r['created'], reverse=True)
+
+    def best(self, class_name=None, percent=None, metric=DEFAULT_METRIC):
+        """
+        Model with the highest `metric`; models without the metric rank last,
+        newer models win ties. Returns None if nothing matches.
+        """
+        matches = self.find(class_name, percent)
+        if not matches:
+            return None
+        return max(matches, key=lambda r: (r['metrics'].get(metric, float('-inf')), r['created']))
+
+    def latest(self, class_name=None, percent=None):
+        matches = self.find(class_name, percent)
+        return matches[0] if matches else None
+
+
+def resolve_model_spec(spec, history_dir=DEFAULT_HISTORY_DIR):
+    """
+    Turn a --model value into a weights path.
+    Plain paths are returned unchanged. 'registry:CLASS', 'registry:CLASS:PERCENT'
+    or 'registry:latest:CLASS[:PERCENT]' are looked up in the registry
+    (best by DEFAULT_METRIC unless 'latest' is given).
+    """
+    if not spec.startswith('registry:'):
+        return spec
+
+    parts = spec[len('registry:'):].split(':')
+    pick_latest = parts[0] == 'latest'
+    if pick_latest:
+        parts = parts[1:]
+    class_name = parts[0] if parts and parts[0] else None
+    percent = int(parts[1]) if len(parts) > 1 and parts[1] else None
+
+    registry = ModelRegistry(history_dir)
+    record = registry.latest(class_name, percent) if pick_latest else registry.best(class_name, percent)
+    if record is None:
+        raise FileNotFoundError(f"No registered model matches {spec} in {history_dir}")
+    return str(registry.path_of(record))
+
+
+def resolve_model_specs(specs, history_dir=DEFAULT_HISTORY_DIR):
+    """
+    Resolve several --model values (e.g. for an ensemble) into weights paths.
+    Besides the forms accepted by resolve_model_spec, 'registry:CLASS:*'
+    expands to the best registered model of every percent of CLASS, e.g. the
+    15/35/100 stages of a three-step run.
+    """
+    paths = []
+    for spec in specs:
+        if not (spec.startswith('registry:') and spec.endswith(':*')):
+            paths.append(resolve_model_spec(spec, history_dir))
+            continue
+
+        class_name = spec[len('registry:'):-2] or None
+        registry = ModelRegistry(history_dir)
+        percents = sorted({r['percent'] for r in registry.find(class_name)})
+        if not percents:
+            raise FileNotFoundError(f"No registered model matches {spec} in {history_dir}")
+        paths.extend(str(registry.path_of(registry.best(class_name, percent))) for percent in percents)
+    return paths
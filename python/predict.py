@@ -1,75 +1,738 @@
 import argparse
+import glob
+import json
 import os
+import queue
 import sys
-import cv2
-from ultralytics import YOLO
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from model_registry import DEFAULT_HISTORY_DIR, resolve_model_spec, resolve_model_specs
+from model_export import BACKEND_PREFERENCE, select_backend
+from profiling import profiler
 
-def predict(model_path, image_path, conf_thres=0.25):
+# cv2, numpy, torch and ultralytics are imported where they are first needed,
+# so --help and the --serve handshake do not pay for them
+
+# Number of models kept in memory by the --serve worker
+MODEL_CACHE_SIZE = 4
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp']
+
+# json: detections only, thumbnail: scaled-down overlay, full: full resolution overlay
+OUTPUT_MODES = ['json', 'thumbnail', 'full']
+THUMBNAIL_MAX_SIZE = 320
+
+# (scale, horizontal flip) passes for --tta, the same ones ultralytics uses for augment=True
+TTA_PASSES = [(1.0, False), (0.83, True), (0.67, False)]
+
+# Boxes of the same class overlapping more than this are fused into one (see weighted_box_fusion)
+FUSION_IOU_THRES = 0.55
+
+_model_cache = OrderedDict()
+_model_cache_size = MODEL_CACHE_SIZE
+
+def load_model(model_path, backend='auto'):
+    """
+    Load a YOLO model, reusing an already loaded instance when possible.
+    Models are cached by absolute path and mtime, so retraining into the
+    same file (e.g. custom_model/weights/best.pt) invalidates the entry.
+    For .pt files an exported ONNX/OpenVINO/TorchScript version is used
+    instead when available (see model_export.select_backend).
+    """
+    model_path, backend_name, _ = select_backend(model_path, backend)
+    abs_path = os.path.abspath(model_path)
+    key = (abs_path, os.path.getmtime(abs_path))
+
+    if key in _model_cache:
+        _model_cache.move_to_end(key)
+        return _model_cache[key]
+
+    # Drop stale entries for the same file before inserting the new one
+    for stale_key in [k for k in _model_cache if k[0] == abs_path]:
+        del _model_cache[stale_key]
+
+    with profiler.phase('model_load'):
+        from ultralytics import YOLO
+        model = YOLO(abs_path) if backend_name == 'pt' else YOLO(abs_path, task='detect')
+    _model_cache[key] = model
+    while len(_model_cache) > _model_cache_size:
+        _model_cache.popitem(last=False)
+    return model
+
+def extract_detections(result):
+    """
+    Convert an ultralytics result into the list of detection dicts used by JSON_OUTPUT.
+    """
+    if isinstance(result, MergedResult):
+        return result.to_detections()
+
+    detections = []
+    for box in result.boxes:
+        # Get normalized coordinates (xywh)
+        # xywhn returns [x_center, y_center, width, height] normalized
+        x_c, y_c, w, h = box.xywhn[0].tolist()
+
+        cls = int(box.cls[0])
+        detections.append({
+            "class_id": cls,
+            "class_name": result.names[cls],
+            "confidence": float(box.conf[0]),
+            "x_center": x_c,
+            "y_center": y_c,
+            "width": w,
+            "height": h
+        })
+    return detections
+
+class MergedResult:
+    """
+    Detections merged from several inference passes over one image
+    (tiles, ensembles). Boxes are absolute xyxy pixels on the original image.
+    Provides plot() like an ultralytics result so ImageWriter can render it.
+    """
+
+    def __init__(self, image, boxes, scores, classes, names):
+        self.orig_img = image
+        self.boxes_xyxy = boxes
+        self.scores = scores
+        self.classes = classes
+        self.names = names
+
+    def to_detections(self):
+        h, w = self.orig_img.shape[:2]
+        detections = []
+        for (x1, y1, x2, y2), score, cls in zip(self.boxes_xyxy.tolist(), self.scores.tolist(), self.classes.tolist()):
+            cls = int(cls)
+            detections.append({
+                "class_id": cls,
+                "class_name": self.names[cls],
+                "confidence": float(score),
+                "x_center": (x1 + x2) / 2 / w,
+                "y_center": (y1 + y2) / 2 / h,
+                "width": (x2 - x1) / w,
+                "height": (y2 - y1) / h
+            })
+        return detections
+
+    def plot(self):
+        import cv2
+
+        canvas = self.orig_img.copy()
+        thickness = max(2, round(max(canvas.shape[:2]) / 600))
+        for (x1, y1, x2, y2), score, cls in zip(self.boxes_xyxy.tolist(), self.scores.tolist(), self.classes.tolist()):
+            p1, p2 = (int(x1), int(y1)), (int(x2), int(y2))
+            cv2.rectangle(canvas, p1, p2, (0, 255, 0), thickness)
+            cv2.putText(canvas, f"{self.names[int(cls)]} {score:.2f}", (p1[0], max(p1[1] - 5, 15)),
+                        cv2.FONT_HERSHEY_SIMPLEX, thickness / 3, (0, 255, 0), max(1, thickness // 2))
+        return canvas
+
+def tile_origins(length, tile_size, stride):
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, stride))
+    origins.append(length - tile_size)
+    return origins
+
+def predict_tiled(model, image, conf_thres=0.25, tile_size=640, tile_overlap=0.2, tile_batch=8, iou_thres=0.5):
+    """
+    Sliced inference for large images.
+
+    The image is cut into overlapping tile_size squares that go through the
+    model tile_batch at a time (tiles are views, so memory is bounded by the
+    tile batch, not the image size). A downscaled full-image pass is added for
+    large objects, then boxes from all passes are merged with class-aware
+    batched NMS. Returns a MergedResult.
+    """
+    import numpy as np
+    import torch
+    import torchvision
+
+    h, w = image.shape[:2]
+    stride = max(1, int(tile_size * (1 - tile_overlap)))
+    tiles = [(x, y) for y in tile_origins(h, tile_size, stride) for x in tile_origins(w, tile_size, stride)]
+
+    boxes, scores, classes = [], [], []
+    names = model.names
+
+    def collect(result, offset_x=0, offset_y=0):
+        if len(result.boxes) == 0:
+            return
+        xyxy = result.boxes.xyxy.cpu().float()
+        boxes.append(xyxy + torch.tensor([offset_x, offset_y, offset_x, offset_y], dtype=xyxy.dtype))
+        scores.append(result.boxes.conf.cpu().float())
+        classes.append(result.boxes.cls.cpu())
+
+    for start in range(0, len(tiles), tile_batch):
+        chunk = tiles[start:start + tile_batch]
+        crops = [np.ascontiguousarray(image[y:y + tile_size, x:x + tile_size]) for x, y in chunk]
+        for (x, y), result in zip(chunk, model(crops, conf=conf_thres, imgsz=tile_size, verbose=False)):
+            collect(result, x, y)
+
+    collect(model(image, conf=conf_thres, verbose=False)[0])
+
+    if not boxes:
+        empty = np.zeros((0, 4), dtype=np.float32)
+        return MergedResult(image, empty, np.zeros(0), np.zeros(0), names)
+
+    boxes = torch.cat(boxes)
+    scores = torch.cat(scores)
+    classes = torch.cat(classes)
+    keep = torchvision.ops.batched_nms(boxes, scores, classes.long(), iou_thres)
+    return MergedResult(image, boxes[keep].numpy(), scores[keep].numpy(), classes[keep].numpy(), names)
+
+def run_inference(model, images, conf_thres=0.25, verbose=True, tile_size=0, tile_overlap=0.2, tile_batch=8):
+    """
+    Run the model over a list of decoded images (or paths when not tiling).
+    Images larger than tile_size (when > 0) go through predict_tiled; Ensembles are never tiled.
+    """
+    if not tile_size or isinstance(model, Ensemble):
+        return model(images, conf=conf_thres, verbose=verbose)
+
+    results = []
+    for image in images:
+        if image.shape[0] > tile_size or image.shape[1] > tile_size:
+            results.append(predict_tiled(model, image, conf_thres, tile_size, tile_overlap, tile_batch))
+        else:
+            results.append(model(image, conf=conf_thres, verbose=verbose)[0])
+    return results
+
+def letterbox(image, size):
+    """
+    Resize an image to fit a size x size square, padded with gray like ultralytics.
+    Returns (padded image, gain, left pad, top pad).
+    """
+    import cv2
+    import numpy as np
+
+    h, w = image.shape[:2]
+    gain = min(size / h, size / w)
+    new_w, new_h = round(w * gain), round(h * gain)
+    left, top = (size - new_w) // 2, (size - new_h) // 2
+    canvas = np.full((size, size, 3), 114, dtype=np.uint8)
+    if (new_w, new_h) != (w, h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    canvas[top:top + new_h, left:left + new_w] = image
+    return canvas, gain, left, top
+
+def weighted_box_fusion(boxes, scores, classes, num_passes, iou_thres=FUSION_IOU_THRES):
+    """
+    Vectorized weighted box fusion of the boxes (xyxy tensors) found by num_passes
+    model/TTA passes over one image.
+
+    Cluster heads are the boxes class-aware NMS keeps; every other box joins the
+    same-class head it overlaps most (NMS guarantees one above iou_thres). Each
+    cluster becomes the score-weighted mean of its boxes, scored with its score
+    sum divided by max(cluster size, num_passes), so boxes only some passes
+    agree on are down-weighted. Returns (boxes, scores, classes).
+    """
+    import torch
+    import torchvision
+
+    keep = torchvision.ops.batched_nms(boxes, scores, classes.long(), iou_thres)
+    iou = torchvision.ops.box_iou(boxes, boxes[keep])
+    iou[classes[:, None] != classes[keep][None, :]] = -1
+    cluster = iou.argmax(dim=1)
+
+    totals = torch.zeros(len(keep)).index_add_(0, cluster, scores)
+    counts = torch.zeros(len(keep)).index_add_(0, cluster, torch.ones_like(scores))
+    fused = torch.zeros((len(keep), 4)).index_add_(0, cluster, boxes * scores[:, None])
+    fused /= totals[:, None]
+    return fused, totals / counts.clamp(min=num_passes), classes[keep]
+
+class Ensemble:
+    """
+    Several models, and optionally TTA passes, run over the same images.
+
+    Images are decoded and letterboxed once into a single imgsz tensor; every
+    TTA pass rescales/flips that tensor once and every model consumes it as is,
+    so an ensemble only adds the model forward passes. Detections are mapped
+    back to the original images and merged with weighted_box_fusion.
+    Called like a YOLO model and returns MergedResults.
+    """
+
+    def __init__(self, models, tta=False, imgsz=640, iou_thres=FUSION_IOU_THRES):
+        names = dict(models[0].names)
+        if any(dict(model.names) != names for model in models[1:]):
+            raise ValueError("Ensembled models must be trained on the same classes")
+        self.models = models
+        self.names = names
+        self.passes = TTA_PASSES if tta else [(1.0, False)]
+        self.imgsz = max(32, -(-imgsz // 32) * 32)
+        self.iou_thres = iou_thres
+
+    def preprocess(self, images):
+        import numpy as np
+        import torch
+
+        padded, transforms = [], []
+        for image in images:
+            canvas, gain, left, top = letterbox(image, self.imgsz)
+            padded.append(canvas)
+            transforms.append((gain, left, top))
+        # BGR HWC uint8 -> RGB BCHW float in [0, 1], the layout ultralytics accepts as a tensor source
+        batch = np.ascontiguousarray(np.stack(padded)[..., ::-1].transpose(0, 3, 1, 2))
+        tensor = torch.from_numpy(batch).float().div_(255)
+        if torch.cuda.is_available():
+            tensor = tensor.cuda()
+        return tensor, transforms
+
+    def __call__(self, images, conf=0.25, verbose=False, **kwargs):
+        import cv2
+        import numpy as np
+        import torch
+        import torch.nn.functional as F
+
+        if isinstance(images, (str, np.ndarray)):
+            images = [images]
+        decoded = []
+        for image in images:
+            if isinstance(image, str):
+                path, image = image, cv2.imread(image)
+                if image is None:
+                    raise ValueError(f"Could not decode image {path}")
+            decoded.append(image)
+
+        with profiler.phase('preprocess'):
+            tensor, transforms = self.preprocess(decoded)
+
+        # Members run at conf / num_passes and conf only applies to the fused
+        # scores: a box fused to >= conf needs a pass scoring >= conf / num_passes,
+        # and filtering members at conf would lose scores that still count
+        num_passes = len(self.passes) * len(self.models)
+        member_conf = conf / num_passes
+
+        found = [([], [], []) for _ in decoded]
+        for scale, flip in self.passes:
+            size = self.imgsz
+            view = tensor
+            if scale != 1.0:
+                size = max(32, round(self.imgsz * scale / 32) * 32)
+                view = F.interpolate(view, size=(size, size), mode='bilinear', align_corners=False)
+            if flip:
+                view = view.flip(3)
+
+            for model in self.models:
+                for (boxes, scores, classes), result in zip(found, model(view, conf=member_conf, verbose=False)):
+                    if len(result.boxes) == 0:
+                        continue
+                    xyxy = result.boxes.xyxy.cpu().float()
+                    if flip:
+                        xyxy[:, [0, 2]] = size - xyxy[:, [2, 0]]
+                    boxes.append(xyxy * (self.imgsz / size))
+                    scores.append(result.boxes.conf.cpu().float())
+                    classes.append(result.boxes.cls.cpu())
+
+        results = []
+        for image, (gain, left, top), (boxes, scores, classes) in zip(decoded, transforms, found):
+            if not boxes:
+                empty = np.zeros((0, 4), dtype=np.float32)
+                results.append(MergedResult(image, empty, np.zeros(0), np.zeros(0), self.names))
+                continue
+
+            h, w = image.shape[:2]
+            boxes = (torch.cat(boxes) - torch.tensor([left, top, left, top])) / gain
+            boxes[:, [0, 2]] = boxes[:, [0, 2]].clamp(0, w)
+            boxes[:, [1, 3]] = boxes[:, [1, 3]].clamp(0, h)
+            with profiler.phase('fusion'):
+                boxes, scores, classes = weighted_box_fusion(boxes, torch.cat(scores), torch.cat(classes),
+                                                             num_passes, self.iou_thres)
+            keep = (scores >= conf).nonzero().flatten()
+            keep = keep[scores[keep].argsort(descending=True)]
+            results.append(MergedResult(image, boxes[keep].numpy(), scores[keep].numpy(), classes[keep].numpy(), self.names))
+        return results
+
+def load_predictor(model_path, backend='auto', tta=False, imgsz=640):
+    """
+    load_model for a single path. A list of paths (or tta) gives an Ensemble
+    whose models are loaded through the same cache, which grows to hold them all.
+    """
+    global _model_cache_size
+
+    if not isinstance(model_path, (list, tuple)) and not tta:
+        return load_model(model_path, backend)
+
+    model_paths = model_path if isinstance(model_path, (list, tuple)) else [model_path]
+    _model_cache_size = max(_model_cache_size, len(model_paths))
+    models = []
+    for path in model_paths:
+        _, backend_name, export_info = select_backend(path, backend)
+        if backend_name != 'pt' and not export_info.get('dynamic', False):
+            # Rescaled TTA passes and whole batches need an export with dynamic shapes
+            path_backend = 'pt' if str(path).endswith('.pt') else backend
+        else:
+            path_backend = backend
+        models.append(load_model(path, path_backend))
+    return Ensemble(models, tta, imgsz)
+
+def get_output_path(image_path, output_mode='full'):
+    """
+    Path of the annotated image inside the "detected" subfolder next to the source image.
+    """
+    directory, filename = os.path.split(image_path)
+    name, ext = os.path.splitext(filename)
+    suffix = '_thumb' if output_mode == 'thumbnail' else '_pred'
+    return os.path.join(directory, 'detected', f"{name}{suffix}{ext}")
+
+def save_plot(result, output_path, output_mode='full'):
+    """
+    Render the detections onto the image and write it to output_path.
+    """
+    import cv2
+
+    res_plotted = result.plot()
+
+    if output_mode == 'thumbnail':
+        h, w = res_plotted.shape[:2]
+        scale = THUMBNAIL_MAX_SIZE / max(h, w)
+        if scale < 1:
+            res_plotted = cv2.resize(res_plotted, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+
+    # Create "detected" subdirectory
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    cv2.imwrite(output_path, res_plotted)
+
+class ImageWriter:
+    """
+    Background thread that plots and writes annotated images,
+    so encoding JPEGs does not block the next inference.
+    """
+
+    def __init__(self, max_pending=32):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                result, output_path, output_mode = item
+                with profiler.phase('io'):
+                    save_plot(result, output_path, output_mode)
+            except Exception as e:
+                print(f"Error writing {item[1]}: {e}", file=sys.stderr)
+            finally:
+                self._queue.task_done()
+
+    def submit(self, result, image_path, output_mode='full'):
+        """
+        Queue an annotated image write and return its path (None in json mode).
+        """
+        if output_mode == 'json':
+            return None
+        output_path = get_output_path(image_path, output_mode)
+        self._queue.put((result, output_path, output_mode))
+        return output_path
+
+    def wait(self):
+        """
+        Block until every queued image has been written.
+        """
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+_image_writer = None
+
+def get_image_writer():
+    global _image_writer
+    if _image_writer is None:
+        _image_writer = ImageWriter()
+    return _image_writer
+
+def run_prediction(model_path, image_path, conf_thres=0.25, verbose=True, output_mode='full', backend='auto',
+                   tile_size=0, tile_overlap=0.2, tile_batch=8, tta=False, imgsz=640):
+    """
+    Run a single prediction and return (output_path, detections).
+    model_path may be a list of paths to predict with an Ensemble.
+    The annotated image (if any) is fully written when this returns.
+    """
+    model = load_predictor(model_path, backend, tta, imgsz)
+    if tile_size:
+        import cv2
+
+        with profiler.phase('decode'):
+            image = cv2.imread(image_path)
+        if image is None:
+            raise ValueError(f"Could not decode image {image_path}")
+        with profiler.phase('inference'):
+            results = run_inference(model, [image], conf_thres, verbose, tile_size, tile_overlap, tile_batch)
+    else:
+        with profiler.phase('inference'):
+            results = model(image_path, conf=conf_thres, verbose=verbose)
+    writer = get_image_writer()
+    output_path = writer.submit(results[0], image_path, output_mode)
+    detections = extract_detections(results[0])
+    writer.wait()
+    return output_path, detections
+
+def predict(model_path, image_path, conf_thres=0.25, output_mode='full', backend='auto',
+            tile_size=0, tile_overlap=0.2, tile_batch=8, tta=False, imgsz=640):
     try:
-        # Load the model
-        model = YOLO(model_path)
-        
-        # Run inference
-        results = model(image_path, conf=conf_thres)
-        
-        # Plot results
-        res_plotted = results[0].plot()
-        
-        # Save the result
-        directory, filename = os.path.split(image_path)
-        name, ext = os.path.splitext(filename)
-        
-        # Create "detected" subdirectory
-        output_dir = os.path.join(directory, 'detected')
-        os.makedirs(output_dir, exist_ok=True)
-        
-        output_filename = f"{name}_pred{ext}"
-        output_path = os.path.join(output_dir, output_filename)
-        
-        cv2.imwrite(output_path, res_plotted)
-        
+        output_path, detections = run_prediction(model_path, image_path, conf_thres, output_mode=output_mode, backend=backend,
+                                                 tile_size=tile_size, tile_overlap=tile_overlap, tile_batch=tile_batch,
+                                                 tta=tta, imgsz=imgsz)
+
         # Print output path to stdout
-        print(f"OUTPUT_PATH:{output_path}")
-        
+        if output_path:
+            print(f"OUTPUT_PATH:{output_path}")
+
         # Print detections
-        detections = []
-        if len(results[0].boxes) > 0:
-            for box in results[0].boxes:
-                # Get normalized coordinates (xywh)
-                # xywhn returns [x_center, y_center, width, height] normalized
-                x_c, y_c, w, h = box.xywhn[0].tolist()
-                
-                cls = int(box.cls[0])
-                conf = float(box.conf[0])
-                name = results[0].names[cls]
-                
-                detections.append({
-                    "class_id": cls,
-                    "class_name": name,
-                    "confidence": conf,
-                    "x_center": x_c,
-                    "y_center": y_c,
-                    "width": w,
-                    "height": h
-                })
-                
-                print(f"Detected: {name} (conf: {conf:.2f})")
+        if detections:
+            for det in detections:
+                print(f"Detected: {det['class_name']} (conf: {det['confidence']:.2f})")
         else:
-             print("No detections found.")
+            print("No detections found.")
 
         # Print JSON output for application parsing
-        import json
         print(f"JSON_OUTPUT:{json.dumps(detections)}")
-            
+
+    except Exception as e:
+        print(f"Error: {str(e)}", file=sys.stderr)
+        sys.exit(1)
+
+def resolve_sources(source):
+    """
+    Expand --source into a list of image paths.
+    Accepts a single image, a directory, a glob pattern, a .txt file with one
+    path per line, or a comma separated list of paths.
+    """
+    if os.path.isdir(source):
+        # Only the top level, so previous "detected" outputs are not picked up
+        return sorted(
+            os.path.join(source, f) for f in os.listdir(source)
+            if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS
+        )
+    if glob.has_magic(source):
+        return sorted(
+            p for p in glob.glob(source, recursive=True)
+            if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS
+        )
+    if source.lower().endswith('.txt') and os.path.isfile(source):
+        with open(source, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+    if ',' in source and not os.path.exists(source):
+        return [p.strip() for p in source.split(',') if p.strip()]
+    return [source]
+
+def iter_decoded_batches(image_paths, batch_size, workers):
+    """
+    Yield lists of (path, image) with images decoded ahead of time on a thread pool.
+    At most two batches are decoded ahead of the one being consumed.
+    image is None when the file could not be decoded.
+    """
+    import cv2
+
+    paths = iter(image_paths)
+    pending = deque()
+
+    def decode(path):
+        with profiler.phase('decode'):
+            return cv2.imread(path)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit_next():
+            path = next(paths, None)
+            if path is not None:
+                pending.append((path, pool.submit(decode, path)))
+
+        for _ in range(batch_size * 2):
+            submit_next()
+
+        batch = []
+        while pending:
+            path, future = pending.popleft()
+            submit_next()
+            batch.append((path, future.result()))
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+def predict_many(model_path, image_paths, conf_thres=0.25, batch_size=8, workers=4, output_mode='full', backend='auto',
+                 tile_size=0, tile_overlap=0.2, tile_batch=8, tta=False, imgsz=640):
+    """
+    Run inference over many images in mini-batches.
+    model_path may be a list of paths to predict with an Ensemble.
+    Prints one JSON_OUTPUT record per image as soon as its batch finishes,
+    followed by a SUMMARY record with throughput.
+    Annotated images are written in the background and are complete once SUMMARY is printed.
+    """
+    try:
+        model = load_predictor(model_path, backend, tta, imgsz)
+        if not isinstance(model, Ensemble):
+            _, backend_name, export_info = select_backend(model_path, backend)
     except Exception as e:
         print(f"Error: {str(e)}", file=sys.stderr)
         sys.exit(1)
 
+    if isinstance(model, Ensemble):
+        # load_predictor already fell back to .pt for exports with a fixed shape
+        print(f"Using an ensemble of {len(model.models)} models x {len(model.passes)} passes", flush=True)
+    else:
+        if backend_name != 'pt' and not export_info.get('dynamic', False):
+            # Exports with a fixed batch dimension take one image at a time
+            batch_size = 1
+            tile_batch = 1
+        print(f"Using {backend_name} backend", flush=True)
+
+    print(f"Running inference on {len(image_paths)} images (batch size {batch_size})...", flush=True)
+
+    writer = get_image_writer()
+    processed = 0
+    failed = 0
+    start_time = time.perf_counter()
+
+    for batch in iter_decoded_batches(image_paths, batch_size, workers):
+        valid = [(path, img) for path, img in batch if img is not None]
+        for path, img in batch:
+            if img is None:
+                failed += 1
+                record = {"source": path, "error": "Could not decode image"}
+                print(f"JSON_OUTPUT:{json.dumps(record)}", flush=True)
+
+        if not valid:
+            continue
+
+        try:
+            with profiler.phase('inference'):
+                results = run_inference(model, [img for _, img in valid], conf_thres, False,
+                                        tile_size, tile_overlap, tile_batch)
+        except Exception as e:
+            failed += len(valid)
+            for path, _ in valid:
+                record = {"source": path, "error": str(e)}
+                print(f"JSON_OUTPUT:{json.dumps(record)}", flush=True)
+            continue
+
+        for (path, _), result in zip(valid, results):
+            record = {
+                "source": path,
+                "output_path": writer.submit(result, path, output_mode),
+                "detections": extract_detections(result)
+            }
+            processed += 1
+            print(f"JSON_OUTPUT:{json.dumps(record)}", flush=True)
+
+    writer.wait()
+    elapsed = time.perf_counter() - start_time
+    summary = {
+        "images": processed,
+        "failed": failed,
+        "seconds": round(elapsed, 3),
+        "images_per_sec": round(processed / elapsed, 2) if elapsed > 0 else 0.0
+    }
+    print(f"SUMMARY:{json.dumps(summary)}", flush=True)
+    return summary
+
+def serve(input_stream=None, output_stream=None, history_dir=DEFAULT_HISTORY_DIR):
+    """
+    Long-lived worker mode.
+    Reads one JSON request per line: {"id": ..., "model": ..., "source": ..., "conf": ..., "output": ...}
+    (optional "tile", "tile_overlap", "tile_batch" enable sliced inference, see predict_tiled;
+    a list of models and/or "tta": true predict with an Ensemble, "imgsz" sets its input size)
+    and writes one JSON response per line:
+      {"id": ..., "ok": true, "output_path": ..., "detections": [...]}
+      {"id": ..., "ok": false, "error": "..."}
+    Models stay loaded between requests (see load_model).
+    "model" may be a registry query such as "registry:CLASS" (see model_registry.resolve_model_spec),
+    or a list of them ("registry:CLASS:*" is every percent of CLASS, see resolve_model_specs).
+    """
+    input_stream = input_stream or sys.stdin
+    output_stream = output_stream or sys.stdout
+
+    # Keep the protocol channel clean: anything else printed goes to stderr
+    sys.stdout = sys.stderr
+
+    def respond(payload):
+        output_stream.write(json.dumps(payload) + "\n")
+        output_stream.flush()
+
+    respond({"ready": True})
+
+    for line in input_stream:
+        line = line.strip()
+        if not line:
+            continue
+
+        request_id = None
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            model = request["model"]
+            output_path, detections = run_prediction(
+                resolve_model_specs(model, history_dir) if isinstance(model, list) else resolve_model_spec(model, history_dir),
+                request["source"],
+                float(request.get("conf", 0.25)),
+                verbose=False,
+                output_mode=request.get("output", "full"),
+                backend=request.get("backend", "auto"),
+                tile_size=int(request.get("tile", 0)),
+                tile_overlap=float(request.get("tile_overlap", 0.2)),
+                tile_batch=int(request.get("tile_batch", 8)),
+                tta=bool(request.get("tta", False)),
+                imgsz=int(request.get("imgsz", 640))
+            )
+            respond({"id": request_id, "ok": True, "output_path": output_path, "detections": detections})
+        except Exception as e:
+            respond({"id": request_id, "ok": False, "error": str(e)})
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--model", required=True, help="Path to .pt model file")
-    parser.add_argument("--source", required=True, help="Path to source image")
+    parser.add_argument("--model", help="Path to .pt model file, or registry:CLASS[:PERCENT] for the best registered model")
+    parser.add_argument("--source", help="Image, directory, glob pattern, .txt list or comma separated paths")
     parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold")
+    parser.add_argument("--batch", type=int, default=8, help="Mini-batch size for multi-image sources")
+    parser.add_argument("--workers", type=int, default=4, help="Threads used to decode images ahead of inference")
+    parser.add_argument("--output-mode", choices=OUTPUT_MODES, default="full",
+                        help="json: detections only, thumbnail: small overlay image, full: full resolution overlay")
+    parser.add_argument("--backend", choices=['auto'] + BACKEND_PREFERENCE, default="auto",
+                        help="Inference backend; auto picks the fastest verified export of the .pt model")
+    parser.add_argument("--tile", type=int, default=0,
+                        help="Sliced inference: tile size in pixels for images larger than this (0 disables)")
+    parser.add_argument("--tile-overlap", type=float, default=0.2, help="Overlap between neighbouring tiles (0-0.9)")
+    parser.add_argument("--tile-batch", type=int, default=8, help="Tiles per inference batch; bounds memory use")
+    parser.add_argument("--ensemble", nargs="+", metavar="MODEL",
+                        help="Predict with several models merged by weighted box fusion; registry:CLASS:* adds every percent of CLASS")
+    parser.add_argument("--tta", action="store_true", help="Test-time augmentation: add flipped and rescaled passes, fused like an ensemble")
+    parser.add_argument("--imgsz", type=int, default=640, help="Input size shared by the models of an ensemble or TTA run")
+    parser.add_argument("--history", default=str(DEFAULT_HISTORY_DIR), help="models_history folder used for registry: lookups")
+    parser.add_argument("--serve", action="store_true", help="Run as a persistent worker speaking JSON lines over stdin/stdout")
+    profiler.add_arguments(parser)
     args = parser.parse_args()
-    
-    predict(args.model, args.source, args.conf)
+    profiler.start(args.profile, 'predict', args.profile_output)
+
+    if args.serve:
+        serve(history_dir=args.history)
+    else:
+        if not (args.model or args.ensemble) or not args.source:
+            parser.error("--model (or --ensemble) and --source are required unless --serve is used")
+        if args.tile and (args.ensemble or args.tta):
+            parser.error("--tile cannot be combined with --ensemble or --tta")
+
+        try:
+            if args.ensemble:
+                model_path = resolve_model_specs(([args.model] if args.model else []) + args.ensemble, args.history)
+            else:
+                model_path = resolve_model_spec(args.model, args.history)
+        except FileNotFoundError as e:
+            print(f"Error: {str(e)}", file=sys.stderr)
+            sys.exit(1)
+
+        sources = resolve_sources(args.source)
+        if len(sources) == 1 and sources[0] == args.source:
+            predict(model_path, args.source, args.conf, args.output_mode, args.backend,
+                    args.tile, args.tile_overlap, max(1, args.tile_batch), args.tta, args.imgsz)
+        elif not sources:
+            print(f"Error: No images found for source {args.source}", file=sys.stderr)
+            sys.exit(1)
+        else:
+            predict_many(model_path, sources, args.conf, max(1, args.batch), max(1, args.workers), args.output_mode, args.backend,
+                         args.tile, args.tile_overlap, max(1, args.tile_batch), args.tta, args.imgsz)
@@ -0,0 +1,307 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from PIL import Image, ImageOps
+
+from file_hashes import FileHashIndex, hash_file
+
+PREFLIGHT_MODES = ['off', 'check', 'normalize']
+
+# Bumped whenever the checks change, so cached results are not reused across versions
+PREFLIGHT_VERSION = 4
+
+# PIL format expected for each image extension
+EXTENSION_FORMATS = {
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+    '.webp': 'WEBP',
+    '.bmp': 'BMP'
+}
+
+# Image formats ultralytics accepts (ultralytics.data.utils.IMG_FORMATS). It
+# checks the decoded format, not the extension, so a PNG named .jpg loads fine
+ULTRALYTICS_IMG_FORMATS = {'bmp', 'dng', 'jpeg', 'jpg', 'mpo', 'png', 'tif', 'tiff', 'webp', 'pfm', 'heic'}
+
+# Problems that make ultralytics skip or fail on an image in check mode
+FATAL_ISSUES = {'unreadable', 'unsupported_format', 'label_format', 'class_out_of_range', 'coords_out_of_range'}
+
+# Image problems that normalize mode fixes by re-encoding
+REENCODE_ISSUES = {'format_mismatch', 'unsupported_format', 'color_mode'}
+
+# Boxes smaller than this (normalized width or height) are treated as degenerate
+MIN_BOX_SIZE = 1e-4
+
+# Slack for rounding in label files when checking normalized values against [0, 1]
+COORD_TOLERANCE = 1e-6
+
+
+def check_image(image_path):
+    """
+    Fully decode an image. Returns (PIL image or None, issues).
+    """
+    issues = []
+    try:
+        img = Image.open(image_path)
+        img.load()
+    except (OSError, Image.DecompressionBombError) as e:
+        return None, [f'unreadable: {e}']
+
+    expected = EXTENSION_FORMATS.get(Path(image_path).suffix.lower())
+    if (img.format or '').lower() not in ULTRALYTICS_IMG_FORMATS:
+        issues.append(f'unsupported_format: content is {img.format}')
+    elif expected and img.format != expected:
+        issues.append(f'format_mismatch: content is {img.format}, extension says {expected}')
+    if img.mode not in ('RGB', 'L'):
+        issues.append(f'color_mode: {img.mode}')
+    return img, issues
+
+
+def check_label(label_path, nc):
+    """
+    Validate a YOLO label file the way ultralytics' verify_image_label does.
+    Returns (repaired lines, issues).
+
+    Lines are boxes (class xc yc w h) or segments (class x1 y1 x2 y2 ...,
+    which ultralytics turns into their bounding box). Fatal are only what
+    ultralytics rejects: other value counts, non-numeric values, values
+    outside [0, 1] and classes >= nc. Boxes whose corners reach past the image
+    are reported as box_clipped. The repaired lines have boxes clipped to the
+    image and invalid, degenerate or duplicate lines removed; valid segments
+    are kept as they are.
+    """
+    issues = []
+    repaired = []
+    seen = set()
+    with open(label_path, 'r') as f:
+        lines = [line.split() for line in f if line.strip()]
+
+    for number, parts in enumerate(lines, 1):
+        is_segment = len(parts) > 6 and len(parts) % 2 == 1
+        if len(parts) != 5 and not is_segment:
+            issues.append(f'label_format: line {number} has {len(parts)} values')
+            continue
+        try:
+            cls = float(parts[0])
+            values = [float(v) for v in parts[1:]]
+        except ValueError:
+            issues.append(f'label_format: line {number} is not numeric')
+            continue
+        if not 0 <= cls < nc:
+            issues.append(f'class_out_of_range: line {number} has class {parts[0]} (nc={nc})')
+            continue
+
+        if is_segment:
+            xs, ys = values[0::2], values[1::2]
+            x1, y1, x2, y2 = min(xs), min(ys), max(xs), max(ys)
+        else:
+            xc, yc, w, h = values
+            x1, y1, x2, y2 = xc - w / 2, yc - h / 2, xc + w / 2, yc + h / 2
+
+        in_range = min(values) >= -COORD_TOLERANCE and max(values) <= 1 + COORD_TOLERANCE
+        if not in_range:
+            issues.append(f'coords_out_of_range: line {number}')
+        elif min(x1, y1) < -COORD_TOLERANCE or max(x2, y2) > 1 + COORD_TOLERANCE:
+            issues.append(f'box_clipped: line {number}')
+        x1, y1, x2, y2 = max(0.0, x1), max(0.0, y1), min(1.0, x2), min(1.0, y2)
+        if x2 - x1 < MIN_BOX_SIZE or y2 - y1 < MIN_BOX_SIZE:
+            issues.append(f'degenerate_box: line {number}')
+            continue
+
+        if is_segment and in_range:
+            line = ' '.join(parts)
+        else:
+            line = f"{int(cls)} {(x1 + x2) / 2:.6f} {(y1 + y2) / 2:.6f} {x2 - x1:.6f} {y2 - y1:.6f}"
+        if line in seen:
+            issues.append(f'duplicate_box: line {number}')
+            continue
+        seen.add(line)
+        repaired.append(line)
+    return repaired, issues
+
+
+def decoded_size(image_path):
+    """
+    (width, height) of the image as cv2, and so ultralytics, reads it (EXIF
+    orientation applied), or None if cv2 cannot decode it.
+    """
+    import cv2
+
+    img = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+    return None if img is None else (img.shape[1], img.shape[0])
+
+
+def inspect_entry(task):
+    """
+    Process pool worker: hash (unless the hash is already known), validate and
+    optionally normalize one image and its label.
+    """
+    image_path, image_sha1, label_path, label_sha1, nc, normalize, max_size, cache_dir = task
+    result = {
+        'image_sha1': image_sha1 or hash_file(image_path),
+        'label_sha1': (label_sha1 or hash_file(label_path)) if label_path else None
+    }
+
+    img, issues = check_image(image_path)
+    if label_path:
+        repaired, label_issues = check_label(label_path, nc)
+        issues.extend(label_issues)
+    else:
+        repaired = None
+    result['issues'] = issues
+
+    kinds = {issue.split(':')[0] for issue in issues}
+    if img is None:
+        result['fatal'] = True
+        return result
+    if not normalize:
+        result['fatal'] = bool(kinds & FATAL_ISSUES)
+        return result
+
+    result['fatal'] = False
+    stem = Path(image_path).stem
+    too_large = max_size and max(img.size) > max_size
+    if too_large or kinds & REENCODE_ISSUES:
+        out_path = (Path(cache_dir) / 'images' / f"{result['image_sha1']}_{max_size or 0}_v{PREFLIGHT_VERSION}"
+                    / f'{stem}.jpg')
+        if not out_path.exists():
+            # The re-encoded copy carries no EXIF, so the orientation is applied to
+            # the pixels; cv2 and the annotator show the source rotated the same way
+            normalized = ImageOps.exif_transpose(img).convert('RGB')
+            source_size = decoded_size(image_path)
+            if source_size is not None and source_size != normalized.size:
+                issues.append(f'orientation_mismatch: normalized {normalized.size}, cv2 reads {source_size}')
+                return result
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            if too_large:
+                normalized.thumbnail((max_size, max_size), Image.LANCZOS)
+            tmp_path = out_path.with_name('.tmp_' + out_path.name)
+            normalized.save(tmp_path, 'JPEG', quality=95)
+            os.replace(tmp_path, out_path)
+        result['image'] = str(out_path)
+    if label_path and issues and kinds - REENCODE_ISSUES:
+        out_label = Path(cache_dir) / 'labels' / f"{result['label_sha1']}_{nc}" / f'{stem}.txt'
+        if not out_label.exists():
+            out_label.parent.mkdir(parents=True, exist_ok=True)
+            tmp_label = out_label.with_name('.tmp_' + out_label.name)
+            with open(tmp_label, 'w') as f:
+                f.write(''.join(line + '\n' for line in repaired))
+            os.replace(tmp_label, out_label)
+        result['label'] = str(out_label)
+    return result
+
+
+class Preflight:
+    """
+    Validation pass over the raw dataset before it is split.
+
+    Every image is fully decoded and checked against its extension, and every
+    label is checked for format, class ids against nc, coordinates outside
+    the image, degenerate and duplicate boxes. The work runs on a process
+    pool. Results are cached in cache_dir/index.json by content hash of the
+    image and label, so unchanged files are never checked twice; hashes are
+    memoized by (path, mtime, size) in `hashes` (file_hashes.FileHashIndex,
+    shared with ResizedImageCache; default cache_dir/hashes.json).
+
+    mode 'check' drops images ultralytics would reject (undecodable or in a
+    format it does not accept, broken labels) and reports the rest, such as
+    an extension that does not match the content;
+    'normalize' re-encodes mislabeled or unusual images as RGB JPEG (down to
+    max_size if given, EXIF orientation applied to the pixels), writes repaired labels
+    into the cache and trains from those.
+    """
+
+    def __init__(self, cache_dir, nc, mode='check', max_size=None, workers=None, hashes=None):
+        self.cache_dir = Path(cache_dir)
+        self.nc = nc
+        self.mode = mode
+        self.max_size = max_size if mode == 'normalize' else None
+        self.workers = workers
+        self.hashes = hashes or FileHashIndex(self.cache_dir / 'hashes.json')
+        self.index_path = self.cache_dir / 'index.json'
+        self.results = {}
+        if self.index_path.exists():
+            try:
+                with open(self.index_path, 'r') as f:
+                    index = json.load(f)
+                if index.get('version') == PREFLIGHT_VERSION:
+                    self.results = index.get('results', {})
+            except (OSError, ValueError):
+                pass
+
+    def _result_key(self, image_sha1, label_sha1):
+        return f"{image_sha1}:{label_sha1}:{self.nc}:{self.mode}:{self.max_size or 0}"
+
+    def apply(self, entries):
+        """
+        Validate the dataset index entries (see build_dataset_index).
+        Returns the entries to train on: fatal ones removed and, in normalize
+        mode, images and labels replaced by their normalized versions.
+        """
+        results = [None] * len(entries)
+        known = []
+        pending = []
+        for i, (stem, image_path, image_sig, label_path, label_sig) in enumerate(entries):
+            image_sha1 = self.hashes.known(image_path, image_sig)
+            label_sha1 = self.hashes.known(label_path, label_sig) if label_path else None
+            known.append((image_sha1, label_sha1))
+            cached = None
+            if image_sha1 and (label_sha1 or label_path is None):
+                cached = self.results.get(self._result_key(image_sha1, label_sha1))
+            if cached and all(Path(cached[k]).exists() for k in ('image', 'label') if cached.get(k)):
+                results[i] = cached
+            else:
+                pending.append(i)
+
+        if pending:
+            tasks = [(str(entries[i][1]), known[i][0], str(entries[i][3]) if entries[i][3] else None, known[i][1],
+                      self.nc, self.mode == 'normalize', self.max_size, str(self.cache_dir)) for i in pending]
+            with ProcessPoolExecutor(max_workers=self.workers or os.cpu_count() or 1) as pool:
+                for i, result in zip(pending, pool.map(inspect_entry, tasks, chunksize=16)):
+                    results[i] = result
+                    stem, image_path, image_sig, label_path, label_sig = entries[i]
+                    self.hashes.record(image_path, image_sig, result['image_sha1'])
+                    if label_path:
+                        self.hashes.record(label_path, label_sig, result['label_sha1'])
+                    self.results[self._result_key(result['image_sha1'], result['label_sha1'])] = result
+
+        self.hashes.save()
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': PREFLIGHT_VERSION, 'results': self.results}, f)
+        os.replace(tmp_path, self.index_path)
+
+        kept = []
+        problems = {}
+        dropped = 0
+        normalized = 0
+        for entry, result in zip(entries, results):
+            stem, image_path, image_sig, label_path, label_sig = entry
+            for issue in result['issues']:
+                problems.setdefault(issue.split(':')[0], []).append(f"{image_path.name}: {issue}")
+            if result['fatal']:
+                dropped += 1
+                continue
+            if result.get('image') or result.get('label'):
+                normalized += 1
+            if result.get('image'):
+                st = os.stat(result['image'])
+                image_path, image_sig = Path(result['image']), [st.st_mtime_ns, st.st_size]
+            if result.get('label'):
+                st = os.stat(result['label'])
+                label_path, label_sig = Path(result['label']), [st.st_mtime_ns, st.st_size]
+            kept.append((stem, image_path, image_sig, label_path, label_sig))
+
+        print(f"Preflight ({self.mode}): {len(entries)} images, {len(pending)} checked, "
+              f"{len(entries) - len(pending)} cached, {normalized} normalized, {dropped} excluded", flush=True)
+        for kind in sorted(problems):
+            examples = problems[kind]
+            print(f"  {kind}: {len(examples)}", flush=True)
+            for example in examples[:3]:
+                print(f"    - {example}", flush=True)
+        if dropped and self.mode == 'check':
+            print("  Excluded images can be repaired with --preflight normalize", flush=True)
+        return kept
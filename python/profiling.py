@@ -0,0 +1,119 @@
+import atexit
+import json
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+PROFILE_MODES = ['timings', 'cprofile', 'pyinstrument']
+
+
+class Profiler:
+    """
+    Phase timings shared by the entry points (predict.py, yolo_trainer.py,
+    reddit_downloader.py), plus an optional cProfile or pyinstrument run.
+
+    Code wraps its work in `profiler.phase(name)`; timings are always
+    collected (it is a perf_counter call per phase) but only reported when
+    --profile is given. Phases entered from several threads add up, so their
+    totals can exceed the wall time. The report is printed to stderr as a
+    PROFILE:{...} line when the process exits, which keeps stdout protocols
+    (JSON_OUTPUT, --serve) untouched.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.mode = None
+        self.script = None
+        self.output = None
+        self.phases = {}
+        self.counts = {}
+        self.lock = threading.Lock()
+        self.started = None
+        self._profiler = None
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profile', nargs='?', const='timings', choices=PROFILE_MODES, default=None,
+                            help='Report phase timings on exit; cprofile/pyinstrument also profile the whole run')
+        parser.add_argument('--profile-output', default=None,
+                            help='Where to write the cProfile stats (.prof) or pyinstrument report (.html)')
+
+    def start(self, mode, script, output=None):
+        """
+        Enable reporting. The time from process creation until now (interpreter
+        startup and top-level imports) is recorded as the 'startup' phase.
+        """
+        if not mode:
+            return
+        import psutil
+
+        self.enabled = True
+        self.mode = mode
+        self.script = script
+        self.output = output
+        self.started = psutil.Process().create_time()
+        self.record('startup', time.time() - self.started)
+
+        if mode == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler as InstrumentProfiler
+                self._profiler = InstrumentProfiler()
+            except ImportError:
+                print("pyinstrument is not installed, falling back to cProfile", file=sys.stderr, flush=True)
+                self.mode = mode = 'cprofile'
+        if mode == 'cprofile':
+            import cProfile
+            self._profiler = cProfile.Profile()
+            self._profiler.enable()
+        elif self._profiler is not None:
+            self._profiler.start()
+
+        atexit.register(self.finish)
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def summary(self):
+        with self.lock:
+            return {
+                'script': self.script,
+                'wall_seconds': round(time.time() - self.started, 4) if self.started else None,
+                'phases': {name: {'seconds': round(seconds, 4), 'count': self.counts[name]}
+                           for name, seconds in self.phases.items()}
+            }
+
+    def finish(self):
+        if not self.enabled:
+            return
+        self.enabled = False
+
+        if self.mode == 'cprofile':
+            self._profiler.disable()
+            path = self.output or f"{self.script}.prof"
+            self._profiler.dump_stats(path)
+            print(f"cProfile stats written to {path} (view with: python -m pstats {path})", file=sys.stderr, flush=True)
+        elif self.mode == 'pyinstrument':
+            self._profiler.stop()
+            path = self.output or f"{self.script}_profile.html"
+            with open(path, 'w') as f:
+                f.write(self._profiler.output_html())
+            print(f"pyinstrument report written to {path}", file=sys.stderr, flush=True)
+        elif self.output:
+            with open(self.output, 'w') as f:
+                json.dump(self.summary(), f, indent=2)
+
+        print(f"PROFILE:{json.dumps(self.summary())}", file=sys.stderr, flush=True)
+
+
+# One instance per process, shared by all modules
+profiler = Profiler()
@@ -1,181 +1,698 @@
 import argparse
-import os
-import requests
 import json
-from pathlib import Path
+import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+
+from profiling import profiler
+
+REDDIT_BASE_URL = 'https://www.reddit.com'
+HEADERS = {'User-Agent': 'YOLOTrainer/1.0'}
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp']
+
+# Checkpoint written into the class folder so an interrupted run can resume
+MANIFEST_NAME = '.download_manifest.json'
+
+# Perceptual hashes of every image in the class folder (including FOR_TESTS)
+PHASH_INDEX_NAME = '.phash_index.jsonl'
+
+# Per-subreddit record of posts already downloaded or rejected (JSON lines, one folder per class)
+SEEN_POSTS_DIR = '.seen_posts'
+
+LISTINGS = ['hot', 'new', 'top', 'rising']
+TIME_FILTERS = ['hour', 'day', 'week', 'month', 'year', 'all']
+
+# Temporary suffix for downloads that have not been validated yet
+PARTIAL_SUFFIX = '.part'
+
+CHUNK_SIZE = 64 * 1024
+
+# Leading bytes -> (PIL format, file extension)
+IMAGE_SIGNATURES = [
+    (b'\xff\xd8\xff', 'JPEG', '.jpg'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG', '.png'),
+]
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter shared by listing and image requests.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity or max(1.0, rate))
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_session(pool_size):
+    """
+    HTTP session with a connection pool large enough for all download workers.
+    """
+    session = requests.Session()
+    session.headers.update(HEADERS)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=2)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def iter_listing(session, url, limiter, after=None, extra_params=None):
+    """
+    Yield (page_cursor, posts, next_after) for each listing page, following 'after' cursors.
+    page_cursor is the cursor that was used to request the page (None for the first one).
+    Only one page is held at a time, so memory stays flat for long listings.
+    """
+    while True:
+        params = {'limit': 100}
+        params.update(extra_params or {})
+        if after:
+            params['after'] = after
+
+        limiter.acquire()
+        with profiler.phase('listing'):
+            response = session.get(url, params=params, timeout=10)
+            response.raise_for_status()
+            data = response.json()
+
+        next_after = data['data'].get('after')
+        yield after, data['data']['children'], next_after
+
+        if not next_after:
+            return
+        after = next_after
+
+
+def sniff_image_format(header):
+    """
+    Identify an image by its magic bytes. Returns (PIL format, extension) or None.
+    """
+    for signature, image_format, ext in IMAGE_SIGNATURES:
+        if header.startswith(signature):
+            return image_format, ext
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'WEBP', '.webp'
+    return None
+
+
+def compute_dhash(img, hash_size=8):
+    """
+    64-bit difference hash: robust to rescaling and recompression, so reposts
+    of the same picture land within a few bits of each other.
+    """
+    gray = img.convert('L').resize((hash_size + 1, hash_size), Image.LANCZOS)
+    pixels = gray.tobytes()
+    value = 0
+    for row in range(hash_size):
+        for col in range(hash_size):
+            left = pixels[row * (hash_size + 1) + col]
+            right = pixels[row * (hash_size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def validate_image(path, expected_format):
+    """
+    Fully decode the file and return its perceptual hash.
+    Raises ValueError for truncated or mislabeled files.
+    """
+    try:
+        with Image.open(path) as img:
+            if img.format != expected_format:
+                raise ValueError(f"content is {img.format}, expected {expected_format}")
+            img.load()
+            return compute_dhash(img)
+    except (OSError, Image.DecompressionBombError) as e:
+        raise ValueError(f"cannot decode image: {e}")
+
+
+def stream_to_file(session, url, partial_path, max_bytes):
+    """
+    Stream a download into partial_path in chunks, enforcing max_bytes.
+    Returns (PIL format, extension) detected from the magic bytes.
+    """
+    with session.get(url, timeout=10, stream=True) as response:
+        response.raise_for_status()
+
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+            raise ValueError(f"file too large ({int(content_length)} bytes)")
+
+        detected = None
+        written = 0
+        with open(partial_path, 'wb') as f:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                if not chunk:
+                    continue
+                if detected is None:
+                    detected = sniff_image_format(chunk[:16])
+                    if detected is None:
+                        raise ValueError("not an image (unrecognized file signature)")
+                written += len(chunk)
+                if written > max_bytes:
+                    raise ValueError(f"file too large (over {max_bytes} bytes)")
+                f.write(chunk)
+
+        if detected is None:
+            raise ValueError("empty response")
+        return detected
+
+
+class PerceptualHashIndex:
+    """
+    Persistent dHash index for one class folder. Rejects near-duplicates both
+    within a run and against images downloaded by earlier runs.
+    Keys are paths relative to the class folder.
+
+    Stored as JSON lines like SeenPostIndex: claims and discards are appended
+    ({"key": ..., "hash": ...}, hash null for a discard), and the file is
+    compacted once per run in load().
+    """
+
+    def __init__(self, root, max_distance=4):
+        self.root = Path(root)
+        self.path = self.root / PHASH_INDEX_NAME
+        self.max_distance = max_distance
+        self.hashes = {}
+        self.lock = threading.Lock()
+
+    def load(self, folders):
+        """
+        Load the saved index and bring it in sync with the images in `folders`:
+        entries for deleted files are dropped, files not yet indexed are hashed.
+        """
+        if self.path.exists():
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # Torn last line from an interrupted run
+                    if record.get('hash'):
+                        self.hashes[record['key']] = int(record['hash'], 16)
+                    else:
+                        self.hashes.pop(record['key'], None)
+
+        on_disk = set()
+        for folder in folders:
+            for entry in os.scandir(folder):
+                if entry.is_file() and os.path.splitext(entry.name)[1].lower() in IMAGE_EXTENSIONS:
+                    on_disk.add(Path(entry.path).relative_to(self.root).as_posix())
+
+        self.hashes = {k: v for k, v in self.hashes.items() if k in on_disk}
+        for key in sorted(on_disk - set(self.hashes)):
+            try:
+                with Image.open(self.root / key) as img:
+                    self.hashes[key] = compute_dhash(img)
+            except Exception:
+                continue
+        self.save()
+
+    def save(self):
+        tmp_path = self.path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            for key, value in self.hashes.items():
+                f.write(json.dumps({'key': key, 'hash': format(value, '016x')}) + '\n')
+        os.replace(tmp_path, self.path)
+
+    def _append(self, key, value):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps({'key': key, 'hash': format(value, '016x') if value is not None else None}) + '\n')
+
+    def claim(self, key, value):
+        """
+        Atomically check for a near-duplicate and, if none exists, record `key`.
+        Returns the key of the duplicate, or None if the image was added.
+        """
+        with self.lock:
+            for existing_key, existing in self.hashes.items():
+                # bin().count rather than int.bit_count, which needs Python 3.10
+                if bin(existing ^ value).count('1') <= self.max_distance:
+                    return existing_key
+            self.hashes[key] = value
+            self._append(key, value)
+            return None
+
+    def discard(self, key):
+        with self.lock:
+            if self.hashes.pop(key, None) is not None:
+                self._append(key, None)
+
+
+class SeenPostIndex:
+    """
+    Posts of one subreddit already handled for a class folder, so later runs
+    skip them before any image request is made.
+
+    Stored as JSON lines (one record per post: id, url, status, reason) and
+    only appended to, so recording a post costs one small write regardless of
+    the index size. status is 'downloaded' or 'rejected'; posts that failed
+    for transient reasons (timeouts, rate limiting, server errors) are not
+    recorded and are retried next time. Posts whose image was deleted by hand
+    stay known, so they are not downloaded again.
+    """
+
+    def __init__(self, root, subreddit):
+        self.root = Path(root)
+        self.path = self.root / SEEN_POSTS_DIR / f"{subreddit.lower()}.jsonl"
+        self.ids = {}
+        self.urls = set()
+        self.lock = threading.Lock()
+
+    def load(self):
+        if not self.path.exists():
+            self.bootstrap()
+            return
+        with open(self.path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Torn last line from an interrupted run
+                self.ids[record['id']] = record['status']
+                if record.get('url'):
+                    self.urls.add(record['url'])
+
+    def bootstrap(self):
+        """
+        First run with an index: files named after post ids (from earlier
+        downloads) count as downloaded.
+        """
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.path, 'a') as f:
+            for folder, dirs, files in os.walk(self.root):
+                dirs[:] = [d for d in dirs if not d.startswith('.') and d != 'yolo_formatted_dataset']
+                for name in files:
+                    stem, ext = os.path.splitext(name)
+                    if ext.lower() in IMAGE_EXTENSIONS and stem not in self.ids:
+                        self.ids[stem] = 'downloaded'
+                        f.write(json.dumps({'id': stem, 'url': None, 'status': 'downloaded'}) + '\n')
+
+    def is_known(self, post_id, url):
+        return post_id in self.ids or url in self.urls
+
+    def record(self, post_id, url, status, reason=None):
+        entry = {'id': post_id, 'url': url, 'status': status}
+        if reason:
+            entry['reason'] = reason
+        with self.lock:
+            self.ids[post_id] = status
+            self.urls.add(url)
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(entry) + '\n')
 
-def download_reddit_images(subreddit, limit, class_name, output_dir, three_step_mode=False):
+    def counts(self):
+        downloaded = sum(1 for status in self.ids.values() if status == 'downloaded')
+        return downloaded, len(self.ids) - downloaded
+
+
+def is_permanent_failure(error):
+    """
+    Whether a failed download should be remembered as rejected: invalid or
+    duplicate content and client errors, but not timeouts, 429 or 5xx.
+    """
+    if isinstance(error, ValueError):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        status = error.response.status_code
+        return 400 <= status < 500 and status != 429
+    return False
+
+
+def get_image_url(post_data):
+    url_field = post_data.get('url_overridden_by_dest') or post_data.get('url')
+    if url_field and any(url_field.lower().endswith(ext) for ext in IMAGE_EXTENSIONS):
+        return url_field
+    return None
+
+
+class DownloadProgress:
+    """
+    Shared download state: distribution counters, in-flight slot reservations,
+    listing page bookkeeping and the resumable manifest.
+
+    Workers reserve a 'test' or 'main' slot before fetching so the pool never
+    downloads more images than the distribution needs.
+    """
+
+    def __init__(self, manifest_path, subreddit, limit, three_step_mode, listing='hot'):
+        self.manifest_path = manifest_path
+        self.subreddit = subreddit
+        self.listing = listing
+        self.limit = limit
+        self.three_step_mode = three_step_mode
+
+        self.test_limit = int(limit * 0.1)
+        if three_step_mode:
+            # Distribution 15% / 35% / 50% of limit (for limit=1000: 150/350/500; for limit=100: 15/35/50)
+            self.count_15 = int(limit * 0.15)
+            self.count_35 = int(limit * 0.35)
+            self.count_50_ideal = limit - self.count_15 - self.count_35  # remainder so total = limit
+        else:
+            self.count_15 = 0
+            self.count_35 = 0
+            self.count_50_ideal = 0
+        # Both modes: test (10%) + main (100% of limit)
+        self.total_needed = self.test_limit + limit
+
+        self.test_downloaded = 0
+        self.main_downloaded = 0
+        self.in_flight = {'test': 0, 'main': 0}
+        self.files = {}
+        self.resume_after = None
+
+        # page index -> [cursor used to fetch it, posts still pending]
+        self.pages = {}
+        self.last_after = None
+
+        self.cond = threading.Condition()
+
+    @property
+    def downloaded(self):
+        return self.test_downloaded + self.main_downloaded
+
+    def split_counts(self):
+        """
+        Return (main_15, main_35, main_50) derived from the main image count.
+        """
+        if not self.three_step_mode:
+            return 0, 0, 0
+        main_15 = min(self.main_downloaded, self.count_15)
+        main_35 = min(max(0, self.main_downloaded - self.count_15), self.count_35)
+        main_50 = max(0, self.main_downloaded - self.count_15 - self.count_35)
+        return main_15, main_35, main_50
+
+    def is_complete(self):
+        with self.cond:
+            return self.downloaded >= self.total_needed
+
+    def load(self, output_path, test_path):
+        """
+        Restore state from a manifest left by an interrupted run with the same settings.
+        Entries whose files are gone are dropped.
+        """
+        if not self.manifest_path.exists():
+            return False
+        try:
+            with open(self.manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        if (manifest.get('subreddit') != self.subreddit or manifest.get('limit') != self.limit
+                or manifest.get('three_step_mode') != self.three_step_mode
+                or manifest.get('listing', 'hot') != self.listing):
+            return False
+
+        for post_id, entry in manifest.get('files', {}).items():
+            folder = test_path if entry['slot'] == 'test' else output_path
+            if (folder / entry['file']).exists():
+                self.files[post_id] = entry
+                if entry['slot'] == 'test':
+                    self.test_downloaded += 1
+                else:
+                    self.main_downloaded += 1
+        self.resume_after = manifest.get('after')
+        return True
+
+    def save(self):
+        # Caller holds self.cond
+        manifest = {
+            'subreddit': self.subreddit,
+            'limit': self.limit,
+            'three_step_mode': self.three_step_mode,
+            'listing': self.listing,
+            'after': self.checkpoint_cursor(),
+            'files': self.files
+        }
+        tmp_path = self.manifest_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+    def remove_manifest(self):
+        if self.manifest_path.exists():
+            self.manifest_path.unlink()
+
+    def checkpoint_cursor(self):
+        """
+        Cursor of the oldest listing page that still has unfinished posts,
+        so resuming refetches that page and skips what is already on disk.
+        """
+        pending = [idx for idx, (_, count) in self.pages.items() if count > 0]
+        if pending:
+            return self.pages[min(pending)][0]
+        return self.last_after
+
+    def start_page(self, idx, cursor, post_count, next_after):
+        with self.cond:
+            self.pages[idx] = [cursor, post_count]
+            self.last_after = next_after
+            if post_count == 0:
+                del self.pages[idx]
+
+    def finish_post(self, page_idx):
+        # Caller holds self.cond
+        page = self.pages.get(page_idx)
+        if page is not None:
+            page[1] -= 1
+            if page[1] <= 0:
+                del self.pages[page_idx]
+
+    def skip_post(self, page_idx):
+        with self.cond:
+            self.finish_post(page_idx)
+
+    def reserve(self):
+        """
+        Reserve a slot for one image. Blocks while all remaining slots are in flight.
+        Returns 'test', 'main', or None once the distribution is complete.
+        """
+        with self.cond:
+            while True:
+                if self.test_downloaded + self.in_flight['test'] < self.test_limit:
+                    slot = 'test'
+                elif self.main_downloaded + self.in_flight['main'] < self.limit:
+                    slot = 'main'
+                elif self.in_flight['test'] or self.in_flight['main']:
+                    # Another worker may still fail and free its slot
+                    self.cond.wait()
+                    continue
+                else:
+                    return None
+                self.in_flight[slot] += 1
+                return slot
+
+    def release(self, slot, page_idx):
+        with self.cond:
+            self.in_flight[slot] -= 1
+            self.finish_post(page_idx)
+            self.cond.notify_all()
+
+    def commit(self, slot, post_id, filename, page_idx):
+        with self.cond:
+            self.in_flight[slot] -= 1
+            self.files[post_id] = {'file': filename, 'slot': slot}
+            if slot == 'test':
+                self.test_downloaded += 1
+            else:
+                self.main_downloaded += 1
+            self.finish_post(page_idx)
+            self.cond.notify_all()
+
+            if slot == 'test':
+                print(f"Downloaded test image {self.test_downloaded}/{self.test_limit}: {filename}", flush=True)
+            elif self.three_step_mode:
+                main_15, main_35, main_50 = self.split_counts()
+                if self.main_downloaded <= self.count_15:
+                    print(f"Downloaded for 15%: {main_15}/{self.count_15}: {filename}", flush=True)
+                elif self.main_downloaded <= self.count_15 + self.count_35:
+                    print(f"Downloaded for 35%: {main_35}/{self.count_35}: {filename}", flush=True)
+                else:
+                    print(f"Downloaded for 50%: {main_50}: {filename}", flush=True)
+            else:
+                print(f"Downloaded main image {self.main_downloaded}/{self.limit}: {filename}", flush=True)
+
+            self.save()
+
+def download_reddit_images(subreddit, limit, class_name, output_dir, three_step_mode=False,
+                           workers=4, rate=2.0, base_url=REDDIT_BASE_URL,
+                           max_size_mb=20, dedup_distance=4, listing='hot', time_filter='all'):
     """
     Download images from Reddit subreddit.
     Also downloads 10% for testing into FOR_TESTS folder.
     If three_step_mode: 10% test, then 15%/35%/50% of limit to folders _15, _35, _50
       (e.g. limit=1000 -> 150/350/500; limit=10 in admin mode -> 1/3/6).
     If three_step_mode is False: 10% test, 100% main.
+
+    Listing pages are fetched while a pool of `workers` threads downloads and
+    writes images over a pooled session. All requests share a token bucket of
+    `rate` requests per second. Progress is checkpointed to a manifest in the
+    class folder, so an interrupted run resumes where it stopped.
+
+    Each image is streamed to a temporary file, checked by magic bytes and a
+    full decode, and rejected if larger than `max_size_mb` or within
+    `dedup_distance` bits of an image already in the class folder
+    (negative disables deduplication). Valid images are renamed into place atomically.
+
+    Posts already downloaded or rejected for this class (see SeenPostIndex)
+    are skipped without any request. `listing` picks the endpoint (hot, new,
+    top, rising); `time_filter` applies to top.
     """
     output_path = Path(output_dir) / class_name
     output_path.mkdir(parents=True, exist_ok=True)
-    
+
     # Create FOR_TESTS folder inside class folder
     test_path = output_path / 'FOR_TESTS'
     test_path.mkdir(parents=True, exist_ok=True)
-    
-    # Calculate test images count (10% of limit)
-    test_limit = int(limit * 0.1)
-    
-    if three_step_mode:
-        # Distribution 15% / 35% / 50% of limit (for limit=1000: 150/350/500; for limit=100: 15/35/50)
-        count_15 = int(limit * 0.15)
-        count_35 = int(limit * 0.35)
-        count_50_ideal = limit - count_15 - count_35  # remainder so total = limit
-        total_needed = test_limit + count_15 + count_35 + count_50_ideal
-    else:
-        # Normal mode: 10% test, 100% main (total 110% of limit)
-        count_15 = 0
-        count_35 = 0
-        count_50_ideal = 0
-        # Total needed: test (10%) + main (100%) = 110% of limit
-        total_needed = test_limit + limit
-    
+
+    # Leftovers from an interrupted run were never validated
+    for folder in (output_path, test_path):
+        for partial in folder.glob(f'*{PARTIAL_SUFFIX}'):
+            partial.unlink()
+
+    with profiler.phase('index'):
+        hash_index = None
+        if dedup_distance >= 0:
+            hash_index = PerceptualHashIndex(output_path, dedup_distance)
+            hash_index.load([output_path, test_path])
+
+        seen = SeenPostIndex(output_path, subreddit)
+        seen.load()
+
+    max_bytes = int(max_size_mb * 1024 * 1024)
+
+    known_downloaded, known_rejected = seen.counts()
+    if known_downloaded or known_rejected:
+        print(f"Skipping known posts: {known_downloaded} downloaded, {known_rejected} rejected before", flush=True)
+
+    listing_key = f"top:{time_filter}" if listing == 'top' else listing
+    progress = DownloadProgress(output_path / MANIFEST_NAME, subreddit, limit, three_step_mode, listing_key)
+    if progress.load(output_path, test_path):
+        print(f"Resuming previous download: {progress.test_downloaded} test, {progress.main_downloaded} main images already saved", flush=True)
+
     # Reddit API endpoint (public, no auth needed for basic access)
-    url = f"https://www.reddit.com/r/{subreddit}/hot.json"
-    headers = {'User-Agent': 'YOLOTrainer/1.0'}
-    
-    downloaded = 0
-    test_downloaded = 0
-    main_15_downloaded = 0
-    main_35_downloaded = 0
-    main_50_downloaded = 0
-    after = None
-    
+    url = f"{base_url}/r/{subreddit}/{listing}.json"
+    listing_params = {'t': time_filter} if listing == 'top' else None
+
+    print(f"Downloading images from r/{subreddit}...")
     if three_step_mode:
-        print(f"Downloading images from r/{subreddit}...")
-        print(f"Distribution: {test_limit} test, {count_15} for 15%, {count_35} for 35%, rest for 50%")
+        print(f"Distribution: {progress.test_limit} test, {progress.count_15} for 15%, {progress.count_35} for 35%, rest for 50%")
     else:
-        print(f"Downloading images from r/{subreddit}...")
-        print(f"Distribution: {test_limit} test (10%), {limit} main (100%)")
-    
-    main_downloaded = 0
-    
-    while True:
-        params = {'limit': 100}
-        if after:
-            params['after'] = after
-        
+        print(f"Distribution: {progress.test_limit} test (10%), {limit} main (100%)")
+
+    session = create_session(workers)
+    limiter = TokenBucket(rate)
+
+    def process_post(post_data, image_url, page_idx):
+        slot = progress.reserve()
+        if slot is None:
+            progress.skip_post(page_idx)
+            return
+
+        folder = test_path if slot == 'test' else output_path
+        partial_path = folder / f"{post_data['id']}{PARTIAL_SUFFIX}"
+        hash_key = None
+
         try:
-            response = requests.get(url, headers=headers, params=params, timeout=10)
-            response.raise_for_status()
-            data = response.json()
-            
-            posts = data['data']['children']
-            after = data['data'].get('after')
-            
-            for post in posts:
-                post_data = post['data']
-                url_field = post_data.get('url_overridden_by_dest') or post_data.get('url')
-                
-                # Check if it's an image
-                if url_field and any(url_field.lower().endswith(ext) for ext in ['.jpg', '.jpeg', '.png', '.webp']):
-                    try:
-                        img_response = requests.get(url_field, headers=headers, timeout=10)
-                        img_response.raise_for_status()
-                        
-                        ext = Path(url_field).suffix or '.jpg'
-                        filename = f"{post_data['id']}{ext}"
-                        
-                        # Determine destination based on download stage
-                        should_stop = False
-                        
-                        if test_downloaded < test_limit:
-                            # First: test images (10%)
-                            filepath = test_path / filename
-                        elif three_step_mode:
-                            # Three-step mode: distribute to 15%, 35%, 50%
-                            if main_15_downloaded < count_15:
-                                filepath = output_path / filename
-                            elif main_35_downloaded < count_35:
-                                filepath = output_path / filename
-                            else:
-                                filepath = output_path / filename
-                        else:
-                            # Normal mode: all remaining images to main folder (100% of limit)
-                            # Check if we already have enough main images BEFORE downloading
-                            if main_downloaded >= limit:
-                                # Skip this image, we already have enough
-                                continue
-                            filepath = output_path / filename
-                        
-                        # Save the file
-                        with open(filepath, 'wb') as f:
-                            f.write(img_response.content)
-                        
-                        # Increment counters after saving file
-                        if test_downloaded < test_limit:
-                            test_downloaded += 1
-                            downloaded += 1
-                            print(f"Downloaded test image {test_downloaded}/{test_limit}: {filename}", flush=True)
-                        elif three_step_mode:
-                            # Three-step mode: increment appropriate counter
-                            if main_15_downloaded < count_15:
-                                main_15_downloaded += 1
-                                downloaded += 1
-                                print(f"Downloaded for 15%: {main_15_downloaded}/{count_15}: {filename}", flush=True)
-                            elif main_35_downloaded < count_35:
-                                main_35_downloaded += 1
-                                downloaded += 1
-                                print(f"Downloaded for 35%: {main_35_downloaded}/{count_35}: {filename}", flush=True)
-                            else:
-                                main_50_downloaded += 1
-                                downloaded += 1
-                                print(f"Downloaded for 50%: {main_50_downloaded}: {filename}", flush=True)
-                                
-                                if downloaded >= total_needed:
-                                    should_stop = True
-                        else:
-                            # Normal mode: increment after saving
-                            main_downloaded += 1
-                            downloaded += 1
-                            print(f"Downloaded main image {main_downloaded}/{limit}: {filename}", flush=True)
-                            
-                            # Check if we have enough main images
-                            if main_downloaded >= limit:
-                                should_stop = True
-                        
-                        time.sleep(0.5)  # Rate limiting
-                        
-                        # Check if we should stop after saving the file
-                        if should_stop:
-                            break
-                    except Exception as e:
-                        print(f"Error downloading {url_field}: {e}")
+            limiter.acquire()
+            with profiler.phase('download'):
+                image_format, ext = stream_to_file(session, image_url, partial_path, max_bytes)
+            with profiler.phase('validate'):
+                image_hash = validate_image(partial_path, image_format)
+
+            # Extension comes from the content, not from the URL
+            filename = f"{post_data['id']}{ext}"
+            filepath = folder / filename
+
+            if hash_index is not None:
+                hash_key = filepath.relative_to(output_path).as_posix()
+                duplicate = hash_index.claim(hash_key, image_hash)
+                if duplicate is not None:
+                    hash_key = None
+                    raise ValueError(f"near-duplicate of {duplicate}")
+
+            os.replace(partial_path, filepath)
+        except Exception as e:
+            print(f"Skipping {image_url}: {e}", flush=True)
+            if partial_path.exists():
+                partial_path.unlink()
+            if hash_key is not None:
+                hash_index.discard(hash_key)
+            if is_permanent_failure(e):
+                seen.record(post_data['id'], image_url, 'rejected', str(e))
+            progress.release(slot, page_idx)
+            return
+
+        seen.record(post_data['id'], image_url, 'downloaded')
+        progress.commit(slot, post_data['id'], filename, page_idx)
+
+    # Bound the number of queued posts so listing stays only a little ahead of the workers
+    queue_slots = threading.BoundedSemaphore(workers * 2)
+
+    def run_post(post_data, image_url, page_idx):
+        try:
+            process_post(post_data, image_url, page_idx)
+        finally:
+            queue_slots.release()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        try:
+            pages = iter_listing(session, url, limiter, progress.resume_after, listing_params)
+            for page_idx, (cursor, posts, next_after) in enumerate(pages):
+                progress.start_page(page_idx, cursor, len(posts), next_after)
+
+                for post in posts:
+                    post_data = post['data']
+                    image_url = get_image_url(post_data)
+                    if (not image_url or post_data['id'] in progress.files or seen.is_known(post_data['id'], image_url)
+                            or progress.is_complete()):
+                        progress.skip_post(page_idx)
                         continue
-            
-            # Check if we should continue outer loop
-            # If we already broke from inner loop, we should break from outer loop too
-            if three_step_mode:
-                if downloaded >= total_needed or not after:
-                    break
-            else:
-                # Normal mode: stop when we have enough main images (test images already downloaded)
-                # We already checked and broke in inner loop, so just verify here
-                if main_downloaded >= limit or not after:
+
+                    queue_slots.acquire()
+                    pool.submit(run_post, post_data, image_url, page_idx)
+
+                if progress.is_complete():
                     break
-                
         except Exception as e:
             print(f"Error fetching from Reddit: {e}")
-            break
-    
+
+    main_total = progress.main_downloaded
+    if progress.is_complete():
+        progress.remove_manifest()
+
+    print(f"Download complete! {main_total} images saved to {output_path}")
     if three_step_mode:
-        main_total = main_15_downloaded + main_35_downloaded + main_50_downloaded
-        print(f"Download complete! {main_total} images saved to {output_path}")
-        print(f"  - Folder 15: {main_15_downloaded}/{count_15}")
-        print(f"  - Folder 35: {main_35_downloaded}/{count_35}")
-        print(f"  - Folder 50: {main_50_downloaded} (ideal: {count_50_ideal})")
-    else:
-        main_total = main_downloaded
-        print(f"Download complete! {main_total} images saved to {output_path}")
-    print(f"Test images: {test_downloaded} images saved to {test_path}")
-    return {'downloaded': main_total, 'test_downloaded': test_downloaded}
+        main_15, main_35, main_50 = progress.split_counts()
+        print(f"  - Folder 15: {main_15}/{progress.count_15}")
+        print(f"  - Folder 35: {main_35}/{progress.count_35}")
+        print(f"  - Folder 50: {main_50} (ideal: {progress.count_50_ideal})")
+    print(f"Test images: {progress.test_downloaded} images saved to {test_path}")
+    return {'downloaded': main_total, 'test_downloaded': progress.test_downloaded}
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Download images from Reddit')
@@ -184,7 +701,20 @@ if __name__ == "__main__":
     parser.add_argument('--class', dest='class_name', required=True)
     parser.add_argument('--output', required=True)
     parser.add_argument('--three-step', action='store_true', help='Use three-step distribution (150, 350, 500)')
-    
-    args = parser.parse_args()
-    download_reddit_images(args.subreddit, args.limit, args.class_name, args.output, args.three_step)
+    parser.add_argument('--workers', type=int, default=4, help='Number of concurrent image downloads')
+    parser.add_argument('--rate', type=float, default=2.0, help='Maximum requests per second (0 disables rate limiting)')
+    parser.add_argument('--max-size-mb', type=float, default=20, help='Reject images larger than this')
+    parser.add_argument('--dedup-distance', type=int, default=4,
+                        help='Max perceptual hash distance (bits) treated as a duplicate; -1 disables deduplication')
+    parser.add_argument('--listing', choices=LISTINGS, default='hot', help='Subreddit listing to read posts from')
+    parser.add_argument('--time', dest='time_filter', choices=TIME_FILTERS, default='all',
+                        help='Time range for --listing top')
+    parser.add_argument('--base-url', default=REDDIT_BASE_URL, help='Reddit base URL (override for testing against a local server)')
+    profiler.add_arguments(parser)
 
+    args = parser.parse_args()
+    profiler.start(args.profile, 'reddit_downloader', args.profile_output)
+    download_reddit_images(args.subreddit, args.limit, args.class_name, args.output, args.three_step,
+                           workers=max(1, args.workers), rate=args.rate, base_url=args.base_url.rstrip('/'),
+                           max_size_mb=args.max_size_mb, dedup_distance=args.dedup_distance,
+                           listing=args.listing, time_filter=args.time_filter)
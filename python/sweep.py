@@ -0,0 +1,255 @@
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+from pathlib import Path
+
+import yaml
+
+from model_registry import DEFAULT_METRIC, ModelRegistry, clean_class_name, hash_dataset
+from training_events import is_final_eval
+
+LEADERBOARD_NAME = 'leaderboard.json'
+
+
+def load_search_space(path):
+    """
+    Read a search space from a JSON or YAML file. Keys are ultralytics train
+    arguments (epochs, batch, imgsz, lr0, momentum, mosaic, ...); values are
+      [a, b, c]                                - pick one of the values
+      {"min": x, "max": y}                     - uniform float
+      {"min": x, "max": y, "log": true}        - log-uniform float
+      {"min": x, "max": y, "int": true}        - uniform integer
+      anything else                            - fixed value
+    """
+    with open(path, 'r') as f:
+        space = yaml.safe_load(f)  # JSON is valid YAML
+    if not isinstance(space, dict) or not space:
+        raise ValueError(f"Search space {path} must be a non-empty mapping")
+    return space
+
+
+def sample_value(spec, rng):
+    if isinstance(spec, list):
+        return rng.choice(spec)
+    if isinstance(spec, dict) and 'min' in spec and 'max' in spec:
+        low, high = spec['min'], spec['max']
+        if spec.get('int'):
+            return rng.randint(int(low), int(high))
+        if spec.get('log'):
+            return math.exp(rng.uniform(math.log(low), math.log(high)))
+        return rng.uniform(low, high)
+    return spec
+
+
+def generate_trials(space, trials, seed=0):
+    """
+    Hyperparameter sets to try: the full grid when every dimension is a list
+    and the grid has at most `trials` points, otherwise `trials` random samples.
+    """
+    if all(isinstance(spec, list) for spec in space.values()):
+        keys = list(space)
+        grid = [dict(zip(keys, values)) for values in itertools.product(*(space[k] for k in keys))]
+        if len(grid) <= trials:
+            return grid
+
+    rng = random.Random(seed)
+    return [{key: sample_value(spec, rng) for key, spec in space.items()} for _ in range(trials)]
+
+
+def split_threads(parallel, cpu_count=None):
+    """
+    Divide the cores between parallel trials: each trial gets cpu_count // parallel
+    torch threads. No cores are kept for dataloader workers, since ultralytics
+    loads images in the training process on CPU (workers=0).
+    """
+    cpu_count = cpu_count or os.cpu_count() or 1
+    return max(1, cpu_count // parallel)
+
+
+def should_stop(history, trial_id, epoch, grace_epochs, min_trials=2):
+    """
+    Median stopping rule: stop a trial once its best metric so far is below the
+    median of what the other trials had reached after the same number of epochs.
+    history maps trial id -> list of per-epoch metric values.
+    """
+    if epoch < grace_epochs:
+        return False
+    own = history.get(trial_id, [])
+    if not own:
+        return False
+    others = [max(values[:epoch]) for tid, values in history.items() if tid != trial_id and len(values) >= epoch]
+    if len(others) < min_trials:
+        return False
+    return max(own) < statistics.median(others)
+
+
+def run_trial(trial_id, params, data_yaml, sweep_dir, base_weights, device, loader_workers, torch_threads,
+              history, grace_epochs, metric=DEFAULT_METRIC):
+    """
+    Train one trial in a worker process and return its result dict.
+    Per-epoch metrics are published to the shared history so other trials can
+    apply the median stopping rule, and this trial stops itself the same way.
+    """
+    from ultralytics import YOLO
+
+    from autotune import pin_torch_threads
+
+    model = YOLO(base_weights)
+    # Set from a callback: the trainer resets torch threads when it selects the device
+    pin_torch_threads(model, torch_threads)
+    values = []
+    stopped = {'early': False}
+
+    def on_fit_epoch_end(trainer):
+        if is_final_eval(trainer, len(values)):
+            return
+        values.append(float((trainer.metrics or {}).get(metric, 0.0)))
+        history[trial_id] = list(values)
+        if should_stop(dict(history), trial_id, len(values), grace_epochs):
+            stopped['early'] = True
+            trainer.stop = True
+
+    model.add_callback('on_fit_epoch_end', on_fit_epoch_end)
+
+    train_kwargs = {
+        'data': str(data_yaml),
+        'project': str(sweep_dir),
+        'name': f'trial_{trial_id:03d}',
+        'exist_ok': True,
+        'verbose': False,
+        'plots': False,
+        'resume': False,
+        'workers': loader_workers,
+        'device': device
+    }
+    train_kwargs.update(params)
+
+    start = time.perf_counter()
+    try:
+        model.train(**train_kwargs)
+        status = 'stopped_early' if stopped['early'] else 'completed'
+        error = None
+    except Exception as e:
+        status, error = 'failed', str(e)
+
+    best = Path(sweep_dir) / f'trial_{trial_id:03d}' / 'weights' / 'best.pt'
+    return {
+        'trial': trial_id,
+        'params': params,
+        'status': status,
+        'error': error,
+        'epochs_run': len(values),
+        'score': max(values) if values else None,
+        'history': values,
+        'training_time': round(time.perf_counter() - start, 2),
+        'weights': str(best) if best.exists() else None
+    }
+
+
+def write_leaderboard(results, sweep_dir, settings):
+    ranked = sorted(results, key=lambda r: (r['score'] is not None, r['score'] or 0.0), reverse=True)
+    with open(sweep_dir / LEADERBOARD_NAME, 'w') as f:
+        json.dump({'created': datetime.now().isoformat(timespec='seconds'), 'settings': settings, 'trials': ranked}, f, indent=2)
+
+    param_keys = sorted({key for r in ranked for key in r['params']})
+    with open(sweep_dir / 'leaderboard.csv', 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['rank', 'trial', 'score', 'status', 'epochs_run', 'training_time'] + param_keys)
+        for rank, r in enumerate(ranked, 1):
+            writer.writerow([rank, r['trial'], r['score'], r['status'], r['epochs_run'], r['training_time']]
+                            + [r['params'].get(k) for k in param_keys])
+    return ranked
+
+
+def run_sweep(data_yaml, space, output_dir, trials=8, parallel=2, device='cpu', workers=2, base_weights='yolov8n.pt',
+              grace_epochs=3, seed=0, defaults=None, model_class_name=None, model_learning_percent=100, events=None):
+    """
+    Hyperparameter sweep over a prepared dataset (data_yaml is shared by all trials).
+
+    Trials run on a process pool of `parallel` workers with the cores split
+    between them (see split_threads); on GPU/MPS they run one at a time.
+    Weak trials are stopped with the median stopping rule on validation
+    mAP50-95 once they trained grace_epochs epochs.
+    defaults (e.g. epochs, batch, imgsz from the command line) apply to every
+    trial unless the search space sets them.
+    Writes OUTPUT/sweep/leaderboard.json (+ .csv) and registers the best
+    trial's weights in models_history. Returns the ranked results.
+    """
+    output_dir = Path(output_dir)
+    sweep_dir = output_dir / 'sweep'
+    sweep_dir.mkdir(parents=True, exist_ok=True)
+
+    if device != 'cpu':
+        parallel = 1
+    parallel = max(1, parallel)
+    torch_threads = split_threads(parallel)
+    # ultralytics ignores dataloader workers on CPU
+    loader_workers = workers if device != 'cpu' else 0
+    param_sets = [dict(defaults or {}, **params) for params in generate_trials(space, trials, seed)]
+
+    print(f"Sweep: {len(param_sets)} trials, {parallel} in parallel "
+          f"({torch_threads} torch threads each)", flush=True)
+    if events:
+        events.emit('sweep_start', trials=len(param_sets), parallel=parallel)
+
+    results = []
+    # Spawned workers start without the parent's torch thread pool state
+    context = multiprocessing.get_context('spawn')
+    with context.Manager() as manager:
+        history = manager.dict()
+        with ProcessPoolExecutor(max_workers=parallel, mp_context=context) as pool:
+            futures = {
+                pool.submit(run_trial, trial_id, params, data_yaml, sweep_dir, base_weights, device,
+                            loader_workers, torch_threads, history, grace_epochs): trial_id
+                for trial_id, params in enumerate(param_sets, 1)
+            }
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                score = f"{result['score']:.4f}" if result['score'] is not None else 'n/a'
+                print(f"Sweep: trial {result['trial']} {result['status']} after {result['epochs_run']} epochs, "
+                      f"mAP50-95 {score} ({len(results)}/{len(param_sets)}) {result['params']}", flush=True)
+                if events:
+                    events.emit('trial_end', **{k: v for k, v in result.items() if k != 'history'})
+
+    settings = {'data': str(data_yaml), 'trials': len(param_sets), 'parallel': parallel, 'grace_epochs': grace_epochs,
+                'seed': seed, 'base_weights': str(base_weights), 'space': space}
+    ranked = write_leaderboard(results, sweep_dir, settings)
+    print(f"Sweep leaderboard saved to: {sweep_dir / LEADERBOARD_NAME}", flush=True)
+
+    winner = next((r for r in ranked if r['weights'] and r['score'] is not None), None)
+    if winner is None:
+        print("Sweep: no trial produced a model.", flush=True)
+        return ranked
+
+    print(f"Sweep winner: trial {winner['trial']} (mAP50-95 {winner['score']:.4f}) {winner['params']}", flush=True)
+    class_name = model_class_name or 'Unknown'
+    if class_name == 'Unknown':
+        with open(data_yaml, 'r') as f:
+            names = yaml.safe_load(f).get('names') or ['Unknown']
+        class_name = names[0] if isinstance(names, list) else list(names.values())[0]
+
+    registry = ModelRegistry(output_dir / 'models_history')
+    unique_name = f"{clean_class_name(class_name)}_{model_learning_percent}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pt"
+    record = registry.register(
+        winner['weights'], unique_name,
+        class_name=class_name,
+        percent=model_learning_percent,
+        dataset_hash=hash_dataset(Path(data_yaml).parent),
+        metrics={DEFAULT_METRIC: winner['score']},
+        training_time=winner['training_time'],
+        base_model=str(base_weights),
+        sweep={'trial': winner['trial'], 'params': winner['params'], 'leaderboard': str(sweep_dir / LEADERBOARD_NAME)}
+    )
+    print(f"Model saved to history: {registry.path_of(record)}", flush=True)
+    if events:
+        events.emit('sweep_end', winner=winner['trial'], score=winner['score'], model=str(registry.path_of(record)))
+    return ranked
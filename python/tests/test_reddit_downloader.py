@@ -0,0 +1,181 @@
+import contextlib
+import io
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from reddit_downloader import (IMAGE_EXTENSIONS, MANIFEST_NAME, SEEN_POSTS_DIR,  # noqa: E402
+                               TokenBucket, download_reddit_images)
+
+PAGE_SIZE = 10
+
+# Post 3 links to an HTML error page, post 5 to the same picture as post 4
+HTML_POST = 3
+DUPLICATE_POSTS = (4, 5)
+
+
+def noise_jpeg(seed):
+    rnd = random.Random(seed)
+    img = Image.new('RGB', (64, 64))
+    img.putdata([(rnd.randrange(256), rnd.randrange(256), rnd.randrange(256)) for _ in range(64 * 64)])
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+class StubReddit:
+    """
+    Local stand-in for reddit.com: /r/SUB/hot.json pages of PAGE_SIZE posts
+    with 'after' cursors, and the images they link to.
+    Listing pages from fail_after on answer 404, to interrupt a run.
+    """
+
+    def __init__(self, posts=40):
+        self.posts = posts
+        self.fail_after = None
+        self.image_requests = {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                stub.handle(self)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.base_url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def handle(self, request):
+        url = urlparse(request.path)
+        if url.path.endswith('/hot.json'):
+            after = int(parse_qs(url.query).get('after', ['0'])[0])
+            if self.fail_after is not None and after >= self.fail_after:
+                request.send_error(404)
+                return
+            end = min(self.posts, after + PAGE_SIZE)
+            children = [{'data': {'id': f'p{i}', 'url': f'{self.base_url}/img/{i}.jpg'}} for i in range(after, end)]
+            body = json.dumps({'data': {'children': children, 'after': str(end) if end < self.posts else None}}).encode()
+        else:
+            index = int(Path(url.path).stem)
+            with self.lock:
+                self.image_requests[index] = self.image_requests.get(index, 0) + 1
+            if index == HTML_POST:
+                body = b'<html><body>Removed</body></html>'
+            else:
+                body = noise_jpeg(DUPLICATE_POSTS[0] if index in DUPLICATE_POSTS else index)
+
+        request.send_response(200)
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+
+class DownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.stub = StubReddit()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.output = Path(self.tmp.name)
+
+    def tearDown(self):
+        self.stub.close()
+        self.tmp.cleanup()
+
+    def download(self, limit=10):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            result = download_reddit_images('stub', limit, 'cat', self.output, workers=4, rate=0,
+                                            base_url=self.stub.base_url)
+        return result, stdout.getvalue()
+
+    def images_in(self, folder):
+        return sorted(p.stem for p in folder.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS)
+
+    def seen_records(self):
+        with open(self.output / 'cat' / SEEN_POSTS_DIR / 'stub.jsonl', 'r') as f:
+            return [json.loads(line) for line in f]
+
+    def test_download_counts_and_rejections(self):
+        result, _ = self.download(limit=10)
+
+        # 10 main images plus 10% for FOR_TESTS
+        self.assertEqual(result, {'downloaded': 10, 'test_downloaded': 1})
+        class_path = self.output / 'cat'
+        self.assertEqual(len(self.images_in(class_path)), 10)
+        self.assertEqual(len(self.images_in(class_path / 'FOR_TESTS')), 1)
+        self.assertFalse((class_path / MANIFEST_NAME).exists())
+
+        rejected = {r['id']: r['reason'] for r in self.seen_records() if r['status'] == 'rejected'}
+        self.assertEqual(len(rejected), 2)
+        self.assertIn(f'p{HTML_POST}', rejected)
+        duplicate = [post for post in (f'p{i}' for i in DUPLICATE_POSTS) if post in rejected]
+        self.assertEqual(len(duplicate), 1)
+        self.assertIn('near-duplicate', rejected[duplicate[0]])
+        self.assertFalse(list(class_path.rglob('*.part')))
+
+    def test_interrupted_run_resumes(self):
+        # Only the first listing page is reachable: 8 usable images out of 11 needed
+        self.stub.fail_after = PAGE_SIZE
+        result, _ = self.download(limit=10)
+        self.assertEqual(result['downloaded'] + result['test_downloaded'], PAGE_SIZE - 2)
+        self.assertTrue((self.output / 'cat' / MANIFEST_NAME).exists())
+
+        self.stub.fail_after = None
+        result, log = self.download(limit=10)
+        self.assertIn('Resuming previous download', log)
+        self.assertEqual(result, {'downloaded': 10, 'test_downloaded': 1})
+        self.assertFalse((self.output / 'cat' / MANIFEST_NAME).exists())
+
+        # Nothing from the first run was fetched again
+        self.assertEqual(max(self.stub.image_requests.values()), 1)
+
+    def test_known_posts_are_skipped(self):
+        self.download(limit=10)
+        requested = sum(self.stub.image_requests.values())
+
+        # A new run for more images only requests posts it has not seen
+        result, log = self.download(limit=12)
+        self.assertIn('Skipping known posts', log)
+        self.assertEqual(max(self.stub.image_requests.values()), 1)
+        self.assertGreater(sum(self.stub.image_requests.values()), requested)
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_rate_is_enforced(self):
+        bucket = TokenBucket(rate=100)
+        start = time.monotonic()
+        for _ in range(150):
+            bucket.acquire()
+        # The first 100 come from the full bucket, the other 50 at 100 per second
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+
+    def test_zero_rate_disables_limiting(self):
+        bucket = TokenBucket(rate=0)
+        start = time.monotonic()
+        for _ in range(1000):
+            bucket.acquire()
+        self.assertLess(time.monotonic() - start, 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+import psutil
+
+
+def is_final_eval(trainer, epochs_seen):
+    """
+    ultralytics calls on_fit_epoch_end once more from final_eval, when best.pt
+    is validated after the last (or early stopped) epoch. True for that call;
+    epochs_seen is the number of epochs the caller already handled in this run.
+    """
+    return trainer.epoch >= trainer.epochs or trainer.epoch < epochs_seen
+
+
+class TrainingEventStream:
+    """
+    Machine-readable training progress: one JSON object per line, written to a
+    file or an inherited file descriptor and driven by ultralytics callbacks.
+
+    Events:
+      train_start  - epochs, batch size, image size, device, dataset size
+      epoch_end    - epoch, losses, validation metrics, epoch wall time,
+                     dataloader wait vs compute time, images/sec, peak RSS
+      train_end    - total time, best model path, final metrics
+                     (the validation of best.pt, which is not an epoch)
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.process = psutil.Process()
+        self.train_start = None
+        self.epochs_seen = 0
+        self._reset_epoch()
+
+    @classmethod
+    def open(cls, path=None, fd=None):
+        """
+        Create a stream on `path` (appended to) or on an inherited file descriptor.
+        Returns None when neither is given.
+        """
+        if fd is not None:
+            return cls(os.fdopen(fd, 'w', buffering=1))
+        if path:
+            return cls(open(path, 'a', buffering=1))
+        return None
+
+    def _reset_epoch(self):
+        self.epoch_start = None
+        self.last_batch_end = None
+        self.batch_start = None
+        self.data_wait = 0.0
+        self.compute = 0.0
+        self.batches = 0
+        self.peak_rss = 0
+
+    def _sample_rss(self):
+        rss = self.process.memory_info().rss
+        try:
+            rss += sum(child.memory_info().rss for child in self.process.children(recursive=True))
+        except psutil.Error:
+            pass
+        self.peak_rss = max(self.peak_rss, rss)
+
+    def emit(self, event, **data):
+        record = {'event': event, 'time': time.time()}
+        record.update(data)
+        try:
+            self.stream.write(json.dumps(record, default=float) + '\n')
+            self.stream.flush()
+        except (OSError, ValueError):
+            # The reader went away; training must not fail because of it
+            pass
+
+    def close(self):
+        try:
+            self.stream.close()
+        except OSError:
+            pass
+
+    def attach(self, model):
+        """
+        Register the callbacks on an ultralytics YOLO model before model.train().
+        """
+        model.add_callback('on_train_start', self.on_train_start)
+        model.add_callback('on_train_epoch_start', self.on_train_epoch_start)
+        model.add_callback('on_train_batch_start', self.on_train_batch_start)
+        model.add_callback('on_train_batch_end', self.on_train_batch_end)
+        model.add_callback('on_fit_epoch_end', self.on_fit_epoch_end)
+        model.add_callback('on_train_end', self.on_train_end)
+
+    def on_train_start(self, trainer):
+        self.train_start = time.perf_counter()
+        self.epochs_seen = getattr(trainer, 'start_epoch', 0)
+        dataset = getattr(trainer.train_loader, 'dataset', None)
+        self.emit('train_start',
+                  epochs=trainer.epochs,
+                  batch_size=trainer.batch_size,
+                  img_size=trainer.args.imgsz,
+                  device=str(trainer.device),
+                  workers=trainer.args.workers,
+                  train_images=len(dataset) if dataset is not None else None)
+
+    def on_train_epoch_start(self, trainer):
+        self._reset_epoch()
+        self.epoch_start = time.perf_counter()
+        self.last_batch_end = self.epoch_start
+
+    def on_train_batch_start(self, trainer):
+        # The batch has already been fetched: the gap since the previous batch is loader wait
+        now = time.perf_counter()
+        self.data_wait += now - self.last_batch_end
+        self.batch_start = now
+
+    def on_train_batch_end(self, trainer):
+        now = time.perf_counter()
+        if self.batch_start is not None:
+            self.compute += now - self.batch_start
+        self.last_batch_end = now
+        self.batches += 1
+        self._sample_rss()
+
+    def on_fit_epoch_end(self, trainer):
+        # Runs after validation, so trainer.metrics holds this epoch's mAP
+        if is_final_eval(trainer, self.epochs_seen):
+            return  # Its metrics are reported by train_end
+        self.epochs_seen = trainer.epoch + 1
+        now = time.perf_counter()
+        epoch_time = now - self.epoch_start if self.epoch_start else None
+        train_time = self.data_wait + self.compute
+
+        dataset = getattr(trainer.train_loader, 'dataset', None)
+        images = len(dataset) if dataset is not None else self.batches * trainer.batch_size
+
+        losses = {}
+        if getattr(trainer, 'tloss', None) is not None:
+            losses = trainer.label_loss_items(trainer.tloss, prefix='train')
+
+        self._sample_rss()
+        self.emit('epoch_end',
+                  epoch=trainer.epoch + 1,
+                  epochs=trainer.epochs,
+                  losses={k: float(v) for k, v in losses.items()},
+                  metrics={k: float(v) for k, v in (trainer.metrics or {}).items()},
+                  epoch_time=epoch_time,
+                  train_time=train_time,
+                  val_time=(epoch_time - train_time) if epoch_time else None,
+                  dataloader_wait=self.data_wait,
+                  compute_time=self.compute,
+                  batches=self.batches,
+                  images_per_sec=(images / train_time) if train_time > 0 else None,
+                  peak_rss=self.peak_rss)
+
+    def on_train_end(self, trainer):
+        self.emit('train_end',
+                  total_time=(time.perf_counter() - self.train_start) if self.train_start else None,
+                  best=str(getattr(trainer, 'best', '')),
+                  metrics={k: float(v) for k, v in (trainer.metrics or {}).items()})
@@ -1,12 +1,24 @@
 import argparse
+import hashlib
+import json
 import os
+import time
 from pathlib import Path
 import yaml
-from ultralytics import YOLO
 import shutil
 import random
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import torch
+from profiling import profiler
+from training_events import TrainingEventStream
+from model_registry import ModelRegistry, clean_class_name, hash_dataset
+from model_export import EXPORT_FORMATS, EXPORT_PRECISIONS, export_model, find_sample_images
+from sweep import load_search_space, run_sweep
+from preflight import PREFLIGHT_MODES, Preflight
+from file_hashes import FileHashIndex
+
+# torch, ultralytics, cv2 and autotune are imported inside the functions that
+# need them, so preparing a dataset (--prepare-only) starts without them
 
 def create_yolo_dataset_structure(dataset_path, classes):
     """
@@ -34,89 +46,505 @@ def create_yolo_dataset_structure(dataset_path, classes):
     
     return yaml_path
 
-def split_dataset(raw_path, dataset_path, train_ratio=0.8):
+# Records which raw files each split entry was materialized from
+SPLIT_MANIFEST_NAME = '.split_manifest.json'
+
+MATERIALIZE_MODES = ['hardlink', 'symlink', 'copy']
+
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.png', '.webp', '.bmp']
+
+def scan_files(folder, extensions):
     """
-    Split raw dataset into train/val sets
+    Single os.scandir pass over folder.
+    Returns {stem: [(Path, signature), ...]} for files with one of the extensions,
+    where signature is (mtime_ns, size) and is used to detect changed sources.
+    """
+    found = {}
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if not entry.is_file():
+                    continue
+                stem, ext = os.path.splitext(entry.name)
+                if ext.lower() not in extensions:
+                    continue
+                st = entry.stat()
+                found.setdefault(stem, []).append((Path(entry.path), [st.st_mtime_ns, st.st_size]))
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    return found
+
+def build_dataset_index(raw_path):
+    """
+    Build a stem -> image/label index for a raw dataset folder with a handful of
+    directory scans instead of probing candidate label paths per image.
+
+    Images are taken from raw_path/images, or raw_path itself if that is empty.
+    Labels are looked up (in priority order) in raw_path/labels,
+    <images dir>/../labels and the images dir itself.
+
+    Returns (entries, report) where entries is a sorted list of
+    (stem, image_path, image_sig, label_path, label_sig) and report holds
+    missing labels, orphan labels and duplicate stems.
     """
     raw_path = Path(raw_path)
-    dataset_path = Path(dataset_path)
-    
-    # Find images
-    # We look for images in both root and 'images' subdir to be safe
-    images = []
-    if (raw_path / 'images').exists():
-        images.extend(list((raw_path / 'images').glob('*.*')))
-    
-    # Also check root for images if empty (fallback)
-    if not images:
-        images.extend([f for f in raw_path.glob('*.*') if f.suffix.lower() in ['.jpg', '.jpeg', '.png', '.webp', '.bmp']])
-    
-    # Filter only valid images
-    images = [img for img in images if img.suffix.lower() in ['.jpg', '.jpeg', '.png', '.webp', '.bmp']]
-    
+
+    images_dir = raw_path / 'images'
+    images = scan_files(images_dir, IMAGE_EXTENSIONS)
     if not images:
-        print(f"Error: No images found in {raw_path}")
+        images_dir = raw_path
+        images = scan_files(images_dir, IMAGE_EXTENSIONS)
+
+    label_dirs = []
+    for folder in [raw_path / 'labels', images_dir.parent / 'labels', images_dir]:
+        if folder not in label_dirs:
+            label_dirs.append(folder)
+
+    labels = {}
+    for folder in reversed(label_dirs):
+        # Later (higher priority) folders overwrite earlier ones
+        for stem, found in scan_files(folder, ['.txt']).items():
+            labels[stem] = found[0]
+
+    entries = []
+    report = {'missing_labels': [], 'orphan_labels': [], 'duplicate_stems': []}
+    for stem in sorted(images):
+        candidates = sorted(images[stem], key=lambda item: item[0].name)
+        if len(candidates) > 1:
+            # Several images would share one label file; keep the first
+            report['duplicate_stems'].append([str(path) for path, _ in candidates])
+        image_path, image_sig = candidates[0]
+
+        label_path, label_sig = labels.get(stem, (None, None))
+        if label_path is None:
+            report['missing_labels'].append(str(image_path))
+        entries.append((stem, image_path, image_sig, label_path, label_sig))
+
+    report['orphan_labels'] = sorted(str(path) for stem, (path, _) in labels.items() if stem not in images)
+    return entries, report
+
+def build_combined_index(raw_paths):
+    """
+    build_dataset_index over several raw folders (e.g. the three-step stage
+    folders). Image names must be unique across folders since they name the
+    files in the formatted dataset; later duplicates are reported and skipped.
+    """
+    entries = []
+    report = {'missing_labels': [], 'orphan_labels': [], 'duplicate_stems': []}
+    seen = {}
+    for raw_path in raw_paths:
+        folder_entries, folder_report = build_dataset_index(raw_path)
+        for key in report:
+            report[key].extend(folder_report[key])
+        for entry in folder_entries:
+            image_path = entry[1]
+            if image_path.name in seen:
+                report['duplicate_stems'].append([str(seen[image_path.name]), str(image_path)])
+                continue
+            seen[image_path.name] = image_path
+            entries.append(entry)
+    return sorted(entries, key=lambda entry: entry[0]), report
+
+def print_dataset_report(report, max_examples=5):
+    def show(title, items):
+        if not items:
+            return
+        print(f"{title}: {len(items)}", flush=True)
+        for item in items[:max_examples]:
+            print(f"  - {item}", flush=True)
+        if len(items) > max_examples:
+            print(f"  ... and {len(items) - max_examples} more", flush=True)
+
+    show("Images without labels (treated as background)", report['missing_labels'])
+    show("Labels without images (ignored)", report['orphan_labels'])
+    show("Duplicate image stems (only the first file is used)",
+         [', '.join(paths) for paths in report['duplicate_stems']])
+
+def materialize_file(src, dst, mode='hardlink'):
+    """
+    Place src at dst without copying when possible.
+    hardlink falls back to symlink, symlink falls back to copy
+    (e.g. across filesystems or on Windows without symlink privileges).
+    Returns the method actually used.
+    """
+    if dst.exists() or dst.is_symlink():
+        dst.unlink()
+
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return 'hardlink'
+        except OSError:
+            mode = 'symlink'
+
+    if mode == 'symlink':
+        try:
+            os.symlink(Path(src).absolute(), dst)
+            return 'symlink'
+        except OSError:
+            pass
+
+    shutil.copy2(src, dst)
+    return 'copy'
+
+class ResizedImageCache:
+    """
+    On-disk cache of images downscaled once to the training size.
+
+    Entries are keyed by the content hash of the source image and the target
+    size (cache_dir/<img_size>/<sha1>/<original name>), so the same picture is
+    resized only once across runs and across the 15/35/50/100 stages.
+    The longest side is scaled to img_size with the aspect ratio kept and no
+    padding, which leaves normalized YOLO labels valid; ultralytics applies its
+    own letterbox on top. Images that are already small enough are used as is.
+
+    Content hashes are memoized by (path, mtime, size) in `hashes`
+    (file_hashes.FileHashIndex, shared with preflight; default
+    cache_dir/index.json), so unchanged sources are not re-read on later runs.
+    """
+
+    def __init__(self, cache_dir, img_size, hashes=None):
+        self.cache_dir = Path(cache_dir)
+        self.img_size = img_size
+        self.hashes = hashes or FileHashIndex(self.cache_dir / 'index.json')
+
+    def resolve(self, image_path, image_sig):
+        """
+        Return (path, signature) of the image to use for training.
+        """
+        digest = self.hashes.get(image_path, image_sig)
+        cached = self.cache_dir / str(self.img_size) / digest / image_path.name
+        marker = cached.parent / '.original'
+
+        if marker.exists():
+            return image_path, image_sig
+
+        if not cached.exists():
+            import cv2
+
+            img = cv2.imread(str(image_path), cv2.IMREAD_COLOR)
+            if img is None:
+                # Let ultralytics report the unreadable file
+                return image_path, image_sig
+
+            cached.parent.mkdir(parents=True, exist_ok=True)
+            h, w = img.shape[:2]
+            scale = self.img_size / max(h, w)
+            if scale >= 1:
+                marker.touch()
+                return image_path, image_sig
+
+            resized = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                                 interpolation=cv2.INTER_AREA)
+            tmp_path = cached.with_name('.tmp_' + cached.name)
+            if not cv2.imwrite(str(tmp_path), resized):
+                return image_path, image_sig
+            os.replace(tmp_path, cached)
+
+        st = cached.stat()
+        return cached, [st.st_mtime_ns, st.st_size]
+
+    def apply(self, entries, workers=None):
+        """
+        Replace the image of every index entry with its cached, resized version.
+        """
+        def resolve_entry(entry):
+            stem, image_path, image_sig, label_path, label_sig = entry
+            image_path, image_sig = self.resolve(image_path, image_sig)
+            return stem, image_path, image_sig, label_path, label_sig
+
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            resolved = list(pool.map(resolve_entry, entries))
+
+        self.hashes.save()
+
+        resized = sum(1 for old, new in zip(entries, resolved) if old[1] != new[1])
+        print(f"Resized image cache ({self.img_size}px): {resized} of {len(entries)} images served from {self.cache_dir}", flush=True)
+        return resolved
+
+def read_label_classes(label_path):
+    """
+    Sorted class ids used in a YOLO label file.
+    """
+    classes = set()
+    try:
+        with open(label_path, 'r') as f:
+            for line in f:
+                parts = line.split()
+                if parts:
+                    try:
+                        classes.add(int(float(parts[0])))
+                    except ValueError:
+                        pass
+    except OSError:
+        pass
+    return sorted(classes)
+
+def split_fingerprint(entries, train_ratio, seed, materialize='hardlink'):
+    """
+    Hash of everything the split depends on: the input files, their
+    signatures, the ratio, the seed and how files are materialized.
+    """
+    digest = hashlib.sha1()
+    digest.update(json.dumps([train_ratio, seed, materialize]).encode())
+    for stem, image_path, image_sig, label_path, label_sig in entries:
+        digest.update(json.dumps([str(image_path.absolute()), image_sig,
+                                  str(label_path.absolute()) if label_path else None, label_sig]).encode())
+    return digest.hexdigest()
+
+def split_outputs_present(dataset_path, files):
+    """
+    Cheap check that the formatted dataset still holds what the manifest lists
+    (same number of images per split), so it was not cleaned by hand.
+    """
+    for split_name in ['train', 'val']:
+        expected = sum(1 for entry in files.values() if split_name in entry['splits'])
+        try:
+            with os.scandir(Path(dataset_path) / split_name / 'images') as found:
+                if sum(1 for _ in found) != expected:
+                    return False
+        except FileNotFoundError:
+            return False
+    return True
+
+def assign_stratified(names, image_classes, assignments, val_ratio, seed=0):
+    """
+    Assign the images missing from `assignments` to train or val, per stratum.
+
+    An image's stratum is its rarest class (or background when unlabeled), so
+    small classes get their share of validation images too: every class with
+    at least two images ends up with one in val. Each stratum is shuffled with
+    a generator seeded from seed and the stratum, so the same inputs always
+    give the same split.
+    """
+    counts = {}
+    for name in names:
+        for cls in image_classes.get(name, []):
+            counts[cls] = counts.get(cls, 0) + 1
+
+    strata = {}
+    for name in names:
+        classes = image_classes.get(name, [])
+        key = min(classes, key=lambda cls: (counts[cls], cls)) if classes else -1
+        strata.setdefault(key, []).append(name)
+
+    for key in sorted(strata):
+        # One generator per stratum, so adding images to one class leaves the others' split alone
+        rng = random.Random(f"{seed}:{key}")
+        members = strata[key]
+        val_count = sum(1 for name in members if assignments.get(name) == ['val'])
+        target = round(len(members) * val_ratio)
+        if key != -1 and len(members) >= 2:
+            target = max(1, target)
+
+        new_names = [name for name in members if name not in assignments]
+        rng.shuffle(new_names)
+        for name in new_names:
+            if val_count < target:
+                assignments[name] = ['val']
+                val_count += 1
+            else:
+                assignments[name] = ['train']
+
+def print_class_split(image_classes, assignments):
+    per_class = {}
+    for name, splits in assignments.items():
+        for cls in image_classes.get(name, []):
+            counts = per_class.setdefault(cls, {'train': 0, 'val': 0})
+            for split_name in splits:
+                counts[split_name] += 1
+    for cls in sorted(per_class):
+        print(f"  Class {cls}: {per_class[cls]['train']} training, {per_class[cls]['val']} validation images", flush=True)
+
+def split_dataset(raw_path, dataset_path, train_ratio=0.8, materialize='hardlink', workers=None, image_cache=None, seed=0,
+                  preflight=None):
+    """
+    Split raw dataset into train/val sets.
+
+    Files are hardlinked (or symlinked/copied, see materialize_file) into the
+    formatted dataset on a thread pool. A manifest in dataset_path remembers
+    the split and the source of every entry, so later runs keep previous
+    assignments and only touch files that were added, changed or removed.
+    Images without a label get no label file, which YOLO treats as background.
+    If preflight (preflight.Preflight) is given, images and labels are
+    validated first and rejected ones are left out.
+    If image_cache (ResizedImageCache) is given, pre-resized images are linked
+    instead of the raw ones.
+    raw_path may be a list of folders whose images are combined.
+
+    New images are split per class with a seeded generator (see
+    assign_stratified), so runs are reproducible and comparable. The class ids
+    of every label are kept in the manifest and only re-read when the label
+    changes; if no input changed at all, the manifest is reused as is.
+    """
+    raw_paths = [Path(p) for p in raw_path] if isinstance(raw_path, (list, tuple)) else [Path(raw_path)]
+    dataset_path = Path(dataset_path)
+
+    entries, report = build_combined_index(raw_paths)
+    print_dataset_report(report)
+
+    if not entries:
+        print(f"Error: No images found in {', '.join(str(p) for p in raw_paths)}")
+        return
+
+    if preflight is not None:
+        entries = preflight.apply(entries)
+        if not entries:
+            print("Error: No usable images left after preflight")
+            return
+
+    if image_cache is not None:
+        entries = image_cache.apply(entries, workers)
+
+    manifest_path = dataset_path / SPLIT_MANIFEST_NAME
+    manifest = {}
+    if manifest_path.exists():
+        try:
+            with open(manifest_path, 'r') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            manifest = {}
+    previous = manifest.get('files', {})
+
+    fingerprint = split_fingerprint(entries, train_ratio, seed, materialize)
+    # Files placed with another --materialize mode are placed again
+    same_mode = manifest.get('materialize', 'hardlink') == materialize
+    if manifest.get('fingerprint') == fingerprint and split_outputs_present(dataset_path, previous):
+        counts = {split_name: sum(1 for entry in previous.values() if split_name in entry['splits'])
+                  for split_name in ['train', 'val']}
+        print(f"Dataset unchanged, reusing split manifest: {counts['train']} training, {counts['val']} validation", flush=True)
         return
 
-    random.shuffle(images)
+    names = [image_path.name for _, image_path, _, _, _ in entries]
+    image_classes = {}
+    for stem, image_path, image_sig, label_path, label_sig in entries:
+        old = previous.get(image_path.name, {})
+        if label_path is None:
+            image_classes[image_path.name] = []
+        elif (old.get('label') == str(label_path.absolute()) and old.get('label_sig') == label_sig
+                and 'classes' in old):
+            image_classes[image_path.name] = old['classes']
+        else:
+            image_classes[image_path.name] = read_label_classes(label_path)
 
-    if len(images) == 1:
-        train_images = images[:]
-        val_images = images[:]
+    # Assign splits: keep previous assignments, distribute new images per class to approach train_ratio
+    if len(names) == 1:
+        assignments = {names[0]: ['train', 'val']}
         print(f"Splitting dataset: 1 image -> use in both train and val (required by YOLO)", flush=True)
     else:
-        split_idx = max(1, int(len(images) * train_ratio))
-        if split_idx >= len(images):
-            split_idx = len(images) - 1
-        train_images = images[:split_idx]
-        val_images = images[split_idx:]
-        print(f"Splitting dataset: {len(train_images)} training, {len(val_images)} validation", flush=True)
-    
-    # Function to copy pair
-    def copy_pair(img_path, split_name):
-        # Copy image
-        shutil.copy2(img_path, dataset_path / split_name / 'images' / img_path.name)
-        
-        # Find label
-        # Labels are expected in 'labels' sibling folder or same folder
-        # Logic: 
-        # 1. Check raw_path/labels/name.txt
-        # 2. Check img_path.parent/../labels/name.txt
-        # 3. Check img_path.parent/name.txt
-        
-        label_name = img_path.stem + '.txt'
-        label_candidates = [
-            raw_path / 'labels' / label_name,
-            img_path.parent.parent / 'labels' / label_name,
-            img_path.parent / label_name
-        ]
-        
-        label_found = False
-        for label_path in label_candidates:
-            if label_path.exists():
-                shutil.copy2(label_path, dataset_path / split_name / 'labels' / label_name)
-                label_found = True
-                break
-        
-        if not label_found:
-            # Create empty label file if not found (background image)
-            (dataset_path / split_name / 'labels' / label_name).touch()
+        assignments = {}
+        for name in names:
+            splits = previous.get(name, {}).get('splits')
+            if splits in (['train'], ['val']):
+                assignments[name] = splits
 
-    # Copy images and labels
-    for img in train_images:
-        copy_pair(img, 'train')
-    
-    for img in val_images:
-        copy_pair(img, 'val')
+        assign_stratified(names, image_classes, assignments, 1 - train_ratio, seed)
+        val_count = sum(1 for splits in assignments.values() if splits == ['val'])
+
+        # Keep at least one image on each side
+        train_count = len(assignments) - val_count
+        if val_count == 0 or train_count == 0:
+            moved = sorted(assignments)[0]
+            assignments[moved] = ['val'] if val_count == 0 else ['train']
+            val_count = sum(1 for splits in assignments.values() if splits == ['val'])
+            train_count = len(assignments) - val_count
+
+        print(f"Splitting dataset: {train_count} training, {val_count} validation", flush=True)
+        print_class_split(image_classes, assignments)
+
+    files = {}
+    wanted = {'train': set(), 'val': set()}
+    tasks = []
+    unchanged = 0
+
+    for stem, image_path, image_sig, label_path, label_sig in entries:
+        label_name = stem + '.txt'
+        entry = {
+            'splits': assignments[image_path.name],
+            'image': str(image_path.absolute()),
+            'image_sig': image_sig,
+            'label': str(label_path.absolute()) if label_path else None,
+            'label_sig': label_sig,
+            'classes': image_classes[image_path.name]
+        }
+        files[image_path.name] = entry
 
-def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device='auto', workers=8, model_class_name=None, model_learning_percent=100):
+        old = previous.get(image_path.name, {})
+        same_source = same_mode and all(old.get(k) == entry[k] for k in ('image', 'image_sig', 'label', 'label_sig'))
+
+        for split_name in entry['splits']:
+            wanted[split_name].add(('images', image_path.name))
+            img_dst = dataset_path / split_name / 'images' / image_path.name
+            label_dst = dataset_path / split_name / 'labels' / label_name
+            if label_path:
+                wanted[split_name].add(('labels', label_name))
+
+            if (same_source and split_name in old.get('splits', []) and img_dst.exists()
+                    and (label_path is None or label_dst.exists())):
+                unchanged += 1
+                continue
+            tasks.append((image_path, img_dst, label_path, label_dst))
+
+    # Remove entries whose source disappeared, lost its label or moved to the other split
+    removed = 0
+    for split_name in ['train', 'val']:
+        for kind in ['images', 'labels']:
+            folder = dataset_path / split_name / kind
+            if not folder.exists():
+                continue
+            for existing in folder.iterdir():
+                if (kind, existing.name) not in wanted[split_name]:
+                    existing.unlink()
+                    removed += 1
+
+    def link_pair(task):
+        image_path, img_dst, label_path, label_dst = task
+        used = {materialize_file(image_path, img_dst, materialize)}
+        if label_path:
+            used.add(materialize_file(label_path, label_dst, materialize))
+        return used
+
+    methods = set()
+    if tasks:
+        with ThreadPoolExecutor(max_workers=workers or min(32, (os.cpu_count() or 1) * 4)) as pool:
+            for used in pool.map(link_pair, tasks):
+                methods.update(used)
+
+    with open(manifest_path, 'w') as f:
+        json.dump({'fingerprint': fingerprint, 'seed': seed, 'train_ratio': train_ratio, 'materialize': materialize,
+                   'files': files}, f)
+
+    print(f"Dataset sync ({', '.join(sorted(methods)) or 'no changes'}): "
+          f"{len(tasks)} updated, {unchanged} unchanged, {removed} removed", flush=True)
+
+def get_model_class_name(data_yaml, model_class_name=None):
     """
-    Train YOLOv8 model with platform-specific optimizations
+    Class name used for history filenames and the registry:
+    the given name, or the first class in data.yaml.
     """
-    output_dir = Path(output_dir)
-    output_dir.mkdir(parents=True, exist_ok=True)
-    
-    # Detect and configure device
+    class_name = model_class_name or 'Unknown'
+    if not class_name or class_name == 'Unknown':
+        # Try to get from data_yaml
+        try:
+            if isinstance(data_yaml, (str, Path)):
+                with open(data_yaml, 'r') as f:
+                    data = yaml.safe_load(f)
+                    if 'names' in data:
+                        classes = data['names']
+                        if isinstance(classes, list) and len(classes) > 0:
+                            class_name = classes[0]
+                        elif isinstance(classes, dict) and len(classes) > 0:
+                            class_name = list(classes.values())[0]
+        except:
+            pass
+    return class_name
+
+def detect_device(device='auto'):
+    """
+    Resolve 'auto' to mps, cuda or cpu.
+    """
+    import torch
+
     if device == 'auto':
         if torch.backends.mps.is_available():
             device = 'mps'
@@ -127,6 +555,30 @@ def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device
         else:
             device = 'cpu'
             print("Using CPU for training.", flush=True)
+    return device
+
+def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device='auto', workers=8, model_class_name=None, model_learning_percent=100,
+                     autotune=False, memory_budget_gb=None, events=None, init_weights='auto',
+                     export_formats=None, export_dynamic=False, export_precision='fp32', torch_threads=None):
+    """
+    Train YOLOv8 model with platform-specific optimizations.
+    With autotune on CPU, batch size and torch threads are picked by a short
+    probe (see autotune.autotune_training) instead of the given values;
+    torch_threads sets the thread count directly (e.g. from an earlier probe).
+    events (TrainingEventStream) receives structured per-epoch progress.
+    init_weights: 'auto' (last.pt/best.pt of the previous run), 'registry'
+    (best registered model for the class) or a path to a .pt file.
+    The best model is registered in models_history (see model_registry) and,
+    if export_formats is given, exported next to it for CPU inference
+    (see model_export.export_model).
+    """
+    from ultralytics import YOLO
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    
+    # Detect and configure device
+    device = detect_device(device)
     
     print(f"Starting training for {epochs} epochs on {device}...", flush=True)
     print(f"Batch size: {batch_size}, Image size: {img_size}, Workers: {workers}", flush=True)
@@ -145,8 +597,18 @@ def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device
     best_pt_path = Path(output_dir) / 'custom_model/weights/best.pt'
     
     model_path = 'yolov8n.pt' # Default fallback
+
+    class_name = get_model_class_name(data_yaml, model_class_name)
+    registry = ModelRegistry(output_dir / 'models_history')
+    registered = registry.best(class_name) if init_weights == 'registry' else None
     
-    if last_pt_path.exists():
+    if init_weights not in ('auto', 'registry'):
+         print(f"Using {init_weights} as starting weights for new training...", flush=True)
+         model_path = str(init_weights)
+    elif registered:
+         print(f"Using best registered model {registered['file']} as starting weights for new training...", flush=True)
+         model_path = str(registry.path_of(registered))
+    elif last_pt_path.exists():
          print(f"Found last.pt, using it as starting weights for new training...", flush=True)
          model_path = str(last_pt_path)
     elif best_pt_path.exists():
@@ -155,12 +617,34 @@ def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device
     else:
          print("No previous model found, starting from base yolov8n.pt...", flush=True)
     
-    try:
-        model = YOLO(model_path)
-    except Exception as e:
-        print(f"Error loading model {model_path}: {e}", flush=True)
-        print("Falling back to yolov8n.pt...", flush=True)
-        model = YOLO('yolov8n.pt')
+    with profiler.phase('model_load'):
+        try:
+            model = YOLO(model_path)
+        except Exception as e:
+            print(f"Error loading model {model_path}: {e}", flush=True)
+            print("Falling back to yolov8n.pt...", flush=True)
+            model = YOLO('yolov8n.pt')
+
+    if autotune:
+        if device == 'cpu':
+            from autotune import autotune_training
+
+            train_images_dir = Path(data_yaml).parent / 'train' / 'images'
+            with profiler.phase('autotune'):
+                tuned = autotune_training(model, train_images_dir, img_size, output_dir,
+                                          batch_size=batch_size, memory_budget_gb=memory_budget_gb)
+            if tuned:
+                batch_size = tuned['batch']
+                torch_threads = tuned['torch_threads']
+                print(f"Using autotuned settings: Batch size: {batch_size}, "
+                      f"Torch threads: {torch_threads}", flush=True)
+        else:
+            print(f"Autotune only applies to CPU training, keeping the given settings on {device}.", flush=True)
+
+    if torch_threads and device in ('cpu', 'mps'):
+        from autotune import pin_torch_threads
+
+        pin_torch_threads(model, torch_threads)
     
     # Train with platform-specific optimizations
     # We set resume=False explicitly to start a new session (Epoch 1)
@@ -192,9 +676,17 @@ def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device
             train_kwargs['amp'] = True  # Mixed precision for CUDA too
             train_kwargs['half'] = False
         
-        results = model.train(**train_kwargs)
+        if events:
+            events.attach(model)
+
+        train_start = time.perf_counter()
+        with profiler.phase('training'):
+            results = model.train(**train_kwargs)
+        training_time = time.perf_counter() - train_start
     except Exception as e:
         print(f"\nTraining failed: {e}", flush=True)
+        if events:
+            events.emit('train_failed', error=str(e))
         raise e
     
     # Export best model
@@ -203,30 +695,8 @@ def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device
     
     # Also save a copy with unique name: CLASSNAME_LEARNINGPERCENT_DATE.pt
     if best_model.exists():
-        # Create models_history directory
-        history_dir = output_dir / 'models_history'
-        history_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Format: CLASSNAME_LEARNINGPERCENT_DATE.pt
-        # Get class name
-        class_name = model_class_name or 'Unknown'
-        if not class_name or class_name == 'Unknown':
-            # Try to get from data_yaml
-            try:
-                if isinstance(data_yaml, (str, Path)):
-                    with open(data_yaml, 'r') as f:
-                        data = yaml.safe_load(f)
-                        if 'names' in data:
-                            classes = data['names']
-                            if isinstance(classes, list) and len(classes) > 0:
-                                class_name = classes[0]
-                            elif isinstance(classes, dict) and len(classes) > 0:
-                                class_name = list(classes.values())[0]
-            except:
-                pass
-        
         # Clean class name (remove spaces, special chars)
-        class_name_clean = class_name.replace(' ', '_').replace('/', '_').replace('\\', '_')[:30]
+        class_name_clean = clean_class_name(class_name)
         
         # Learning percent (100 for normal, 15/35/50 for three-step)
         learning_percent_str = f"{model_learning_percent}"
@@ -236,14 +706,117 @@ def train_yolo_model(data_yaml, epochs, batch_size, img_size, output_dir, device
         
         # Final format: CLASSNAME_LEARNINGPERCENT_DATE.pt
         unique_name = f"{class_name_clean}_{learning_percent_str}_{timestamp}.pt"
-        history_model = history_dir / unique_name
-        
-        # Copy best model to history
-        shutil.copy2(best_model, history_model)
-        print(f"Model saved to history: {history_model}", flush=True)
+
+        metrics = getattr(results, 'results_dict', None) or getattr(getattr(model, 'trainer', None), 'metrics', None) or {}
+        record = registry.register(
+            best_model, unique_name,
+            class_name=class_name,
+            percent=model_learning_percent,
+            dataset_hash=hash_dataset(Path(data_yaml).parent),
+            metrics=metrics,
+            training_time=round(training_time, 2),
+            epochs=epochs,
+            img_size=img_size,
+            batch_size=batch_size,
+            base_model=str(model_path)
+        )
+        print(f"Model saved to history: {registry.path_of(record)}", flush=True)
+
+        if export_formats:
+            raw_path = Path(data_yaml).parent.parent
+            with profiler.phase('export'):
+                exports = export_model(YOLO, best_model, registry.path_of(record), export_formats, img_size,
+                                       data_yaml=data_yaml, dynamic=export_dynamic, precision=export_precision,
+                                       sample_images=find_sample_images(raw_path))
+            record['exports'] = {fmt: info['file'] for fmt, info in exports.items()}
+            registry.save()
     
     return best_model
 
+# Stage folders of the three-step system (CLASSNAME_15, _35, _50) and the stages it trains
+THREE_STEP_FOLDERS = [15, 35, 50]
+THREE_STEP_STAGES = [15, 35, 100]
+
+def three_step_folders(base_path, class_name, stage):
+    """
+    Raw folders making up a three-step stage. Stages are cumulative:
+    stage 35 trains on the 15 and 35 folders, stage 100 on all of them
+    (the same images the merged CLASSNAME_100 folder holds).
+    """
+    folders = []
+    for percent in THREE_STEP_FOLDERS:
+        folder = Path(base_path) / f"{class_name}_{percent}"
+        if percent <= stage and folder.is_dir():
+            folders.append(folder)
+    return folders
+
+def run_three_step(base_path, class_names, epochs, batch_size, img_size, output_dir, stages=None, stage_epochs=None,
+                   seed=0, materialize='hardlink', image_cache=None, preflight=None, autotune=False, events=None,
+                   **train_options):
+    """
+    Train all three-step stages in one run.
+
+    All stages share one formatted dataset (base_path/yolo_formatted_dataset)
+    and its split manifest: the seeded split is made for the first stage and
+    only grows afterwards, so earlier images keep their train/val side and
+    only new files are linked. The resized image cache, ultralytics label
+    caches and autotune results carry over as well. Every stage starts from
+    the best weights of the previous one.
+    Returns the list of best model paths, one per trained stage.
+    """
+    base_path = Path(base_path)
+    output_dir = Path(output_dir)
+    class_name = train_options.pop('model_class_name', None) or class_names[0]
+    init_weights = train_options.pop('init_weights', 'auto')
+    stages = stages or THREE_STEP_STAGES
+
+    dataset_path = base_path / 'yolo_formatted_dataset'
+    dataset_path.mkdir(parents=True, exist_ok=True)
+    yaml_path = create_yolo_dataset_structure(dataset_path, class_names)
+
+    best_models = []
+    for index, stage in enumerate(stages):
+        folders = three_step_folders(base_path, class_name, stage)
+        if not folders:
+            print(f"Three-step stage {stage}%: no stage folders found in {base_path}, skipping.", flush=True)
+            continue
+
+        print(f"\n=== Three-step stage {stage}% ({', '.join(f.name for f in folders)}) ===", flush=True)
+        if events:
+            events.emit('stage_start', stage=stage, index=index + 1, stages=len(stages),
+                        folders=[str(f) for f in folders])
+
+        with profiler.phase('dataset_prep'):
+            split_dataset(folders, dataset_path, materialize=materialize, image_cache=image_cache, seed=seed,
+                          preflight=preflight)
+
+        stage_epoch_count = stage_epochs[index] if stage_epochs and index < len(stage_epochs) else epochs
+        best_model = train_yolo_model(yaml_path, stage_epoch_count, batch_size, img_size, output_dir,
+                                      model_class_name=class_name, model_learning_percent=stage,
+                                      autotune=autotune, events=events, init_weights=init_weights,
+                                      **train_options)
+        best_models.append(best_model)
+
+        # Warm start the next stage; the weights are loaded before its run overwrites best.pt
+        init_weights = str(best_model)
+
+        # The probe only needs to run once per machine and image size
+        if autotune:
+            from autotune import AUTOTUNE_FILENAME
+
+            autotune_path = output_dir / AUTOTUNE_FILENAME
+            if autotune_path.exists():
+                with open(autotune_path, 'r') as f:
+                    tuned = json.load(f)['selected']
+                batch_size = tuned['batch']
+                train_options['torch_threads'] = tuned['torch_threads']
+                autotune = False
+
+        if events:
+            events.emit('stage_end', stage=stage, best=str(best_model))
+
+    return best_models
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Train YOLO model')
     parser.add_argument('--data', required=True, help='Dataset path (raw folder)')
@@ -256,29 +829,132 @@ if __name__ == "__main__":
     parser.add_argument('--workers', type=int, default=8, help='Number of data loading workers')
     parser.add_argument('--model-class-name', type=str, default=None, help='Class name for model filename')
     parser.add_argument('--model-learning-percent', type=int, default=100, help='Learning percent for model filename (15, 35, 50, or 100)')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Probe and pick batch size and torch threads for CPU training')
+    parser.add_argument('--memory-budget-gb', type=float, default=None,
+                        help='Memory budget for --autotune (default: 80%% of available RAM)')
+    parser.add_argument('--events', type=str, default=None,
+                        help='Append structured training events (JSON lines) to this file')
+    parser.add_argument('--events-fd', type=int, default=None,
+                        help='Write structured training events (JSON lines) to this inherited file descriptor')
+    parser.add_argument('--init-weights', type=str, default='auto',
+                        help="Starting weights: 'auto' (previous last.pt/best.pt), 'registry' (best registered model for the class) or a .pt path")
+    parser.add_argument('--export', type=str, default='',
+                        help=f"Comma separated formats to export the best model to after training ({', '.join(EXPORT_FORMATS)})")
+    parser.add_argument('--export-dynamic', action='store_true', help='Export ONNX with a dynamic batch dimension')
+    parser.add_argument('--export-precision', choices=EXPORT_PRECISIONS, default='fp32',
+                        help='fp16 needs a GPU; int8 uses onnxruntime dynamic quantization (ONNX) or NNCF calibration (OpenVINO)')
+    parser.add_argument('--materialize', choices=MATERIALIZE_MODES, default='hardlink',
+                        help='How files are placed into the formatted dataset (hardlink falls back to symlink, then copy)')
+    parser.add_argument('--cache-resized', action='store_true',
+                        help='Resize images once to --img and train from a persistent cache')
+    parser.add_argument('--image-cache', type=str, default=None,
+                        help='Directory for the resized image cache (default: OUTPUT/image_cache)')
+    parser.add_argument('--preflight', choices=PREFLIGHT_MODES, default='check',
+                        help='Validate images and labels before splitting: check drops files ultralytics would reject '
+                             'and reports the rest, normalize re-encodes images and repairs labels')
+    parser.add_argument('--preflight-max-size', type=int, default=None,
+                        help='With --preflight normalize, downscale images larger than this (longest side, pixels)')
+    parser.add_argument('--rebuild-dataset', action='store_true', help='Delete the formatted dataset and rebuild it from scratch')
+    parser.add_argument('--three-step', action='store_true',
+                        help='Train all three-step stages in one run; --data is the folder holding CLASSNAME_15/_35/_50')
+    parser.add_argument('--stages', type=str, default=','.join(map(str, THREE_STEP_STAGES)),
+                        help='Three-step stages (learning percents) to train')
+    parser.add_argument('--stage-epochs', type=str, default=None,
+                        help='Comma separated epochs per three-step stage (default: --epochs for every stage)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the train/val split and sweep sampling')
+    parser.add_argument('--sweep', type=str, default=None,
+                        help='Run a hyperparameter sweep over the search space in this JSON/YAML file instead of a single training')
+    parser.add_argument('--sweep-trials', type=int, default=8, help='Number of sweep trials (a smaller full grid is used as is)')
+    parser.add_argument('--sweep-parallel', type=int, default=2, help='Sweep trials trained at the same time on CPU')
+    parser.add_argument('--sweep-grace-epochs', type=int, default=3,
+                        help='Epochs before the median stopping rule may stop a sweep trial')
+    parser.add_argument('--prepare-only', action='store_true',
+                        help='Only validate, split and link the dataset, then exit without training')
+    profiler.add_arguments(parser)
     
     args = parser.parse_args()
+    profiler.start(args.profile, 'yolo_trainer', args.profile_output)
     
     # Parse class names
     class_names = [c.strip() for c in args.class_names.split(',')]
     print(f"Classes: {class_names}", flush=True)
     
+    export_formats = [f.strip() for f in args.export.split(',') if f.strip()]
+
     # Create dataset structure
     # We create a temporary formatted dataset inside the class folder
+    # (for --three-step, inside the folder holding the stage folders)
     dataset_path = Path(args.data) / 'yolo_formatted_dataset'
     
-    # Clean up previous run
-    if dataset_path.exists():
+    # The formatted dataset is synced incrementally; only wipe it on request
+    if args.rebuild_dataset and dataset_path.exists():
         shutil.rmtree(dataset_path)
-    dataset_path.mkdir(parents=True)
-        
-    yaml_path = create_yolo_dataset_structure(dataset_path, class_names)
+    dataset_path.mkdir(parents=True, exist_ok=True)
     
-    # Split dataset
-    split_dataset(args.data, dataset_path)
-    
-    # Train with device and workers parameters
-    train_yolo_model(yaml_path, args.epochs, args.batch, args.img, args.output, 
-                     device=args.device, workers=args.workers,
-                     model_class_name=args.model_class_name,
-                     model_learning_percent=args.model_learning_percent)
+    # Content hashes shared by preflight and the image cache, so each file is hashed once
+    file_hashes = FileHashIndex(Path(args.output) / 'file_hashes.json')
+
+    image_cache = None
+    if args.cache_resized:
+        image_cache = ResizedImageCache(args.image_cache or Path(args.output) / 'image_cache', args.img,
+                                        hashes=file_hashes)
+
+    preflight = None
+    if args.preflight != 'off':
+        preflight = Preflight(Path(args.output) / 'preflight_cache', len(class_names), args.preflight,
+                              max_size=args.preflight_max_size, hashes=file_hashes)
+
+    events = TrainingEventStream.open(args.events, args.events_fd)
+
+    if args.prepare_only:
+        raw_path = args.data
+        if args.three_step:
+            stages = [int(s) for s in args.stages.split(',') if s.strip()]
+            raw_path = three_step_folders(args.data, args.model_class_name or class_names[0], max(stages))
+        with profiler.phase('dataset_prep'):
+            create_yolo_dataset_structure(dataset_path, class_names)
+            split_dataset(raw_path, dataset_path, materialize=args.materialize, image_cache=image_cache, seed=args.seed,
+                          preflight=preflight)
+    elif args.three_step:
+        run_three_step(args.data, class_names, args.epochs, args.batch, args.img, args.output,
+                       stages=[int(s) for s in args.stages.split(',') if s.strip()],
+                       stage_epochs=[int(e) for e in args.stage_epochs.split(',') if e.strip()] if args.stage_epochs else None,
+                       seed=args.seed, materialize=args.materialize, image_cache=image_cache, preflight=preflight,
+                       autotune=args.autotune, events=events,
+                       device=args.device, workers=args.workers,
+                       model_class_name=args.model_class_name,
+                       memory_budget_gb=args.memory_budget_gb, init_weights=args.init_weights,
+                       export_formats=export_formats,
+                       export_dynamic=args.export_dynamic, export_precision=args.export_precision)
+    else:
+        with profiler.phase('dataset_prep'):
+            yaml_path = create_yolo_dataset_structure(dataset_path, class_names)
+
+            # Split dataset
+            split_dataset(args.data, dataset_path, materialize=args.materialize, image_cache=image_cache, seed=args.seed,
+                          preflight=preflight)
+
+        if args.sweep:
+            # Trials start from the given weights, or the base model for a fair comparison
+            base_weights = args.init_weights if args.init_weights not in ('auto', 'registry') else 'yolov8n.pt'
+            run_sweep(yaml_path, load_search_space(args.sweep), args.output,
+                      trials=args.sweep_trials, parallel=args.sweep_parallel,
+                      device=detect_device(args.device), workers=args.workers, base_weights=base_weights,
+                      grace_epochs=args.sweep_grace_epochs, seed=args.seed,
+                      defaults={'epochs': args.epochs, 'batch': args.batch, 'imgsz': args.img},
+                      model_class_name=args.model_class_name,
+                      model_learning_percent=args.model_learning_percent, events=events)
+        else:
+            # Train with device and workers parameters
+            train_yolo_model(yaml_path, args.epochs, args.batch, args.img, args.output, 
+                             device=args.device, workers=args.workers,
+                             model_class_name=args.model_class_name,
+                             model_learning_percent=args.model_learning_percent,
+                             autotune=args.autotune, memory_budget_gb=args.memory_budget_gb,
+                             events=events, init_weights=args.init_weights,
+                             export_formats=export_formats,
+                             export_dynamic=args.export_dynamic, export_precision=args.export_precision)
+
+    if events:
+        events.close()
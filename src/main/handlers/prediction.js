@@ -1,13 +1,130 @@
 const path = require('path');
+const readline = require('readline');
 const { spawn } = require('child_process');
+const { app } = require('electron');
 const { logger } = require('../utils/logger');
 
+// Persistent predict.py --serve worker state
+let predictWorker = null;
+let nextRequestId = 1;
+const pendingRequests = new Map();
+
+/**
+ * Rejects every in-flight prediction request.
+ * @param {Error} error - Error passed to each pending promise.
+ */
+function rejectPendingRequests(error) {
+  for (const { reject } of pendingRequests.values()) {
+    reject(error);
+  }
+  pendingRequests.clear();
+}
+
+/**
+ * Returns the running prediction worker, starting one if needed.
+ * The worker keeps models loaded between requests, so only the first
+ * prediction pays the Python/ultralytics startup and model load cost.
+ * @returns {import('child_process').ChildProcess} The worker process.
+ */
+function getPredictWorker() {
+  if (predictWorker) {
+    return predictWorker;
+  }
+
+  const pythonPath = process.platform === 'win32' ? 'python' : 'python3';
+  const scriptPath = path.join(__dirname, '../../../python/predict.py');
+
+  const worker = spawn(pythonPath, [scriptPath, '--serve']);
+  predictWorker = worker;
+
+  const rl = readline.createInterface({ input: worker.stdout });
+  rl.on('line', (line) => {
+    let message;
+    try {
+      message = JSON.parse(line);
+    } catch (e) {
+      logger.debug('Prediction worker output', line);
+      return;
+    }
+
+    if (message.ready) {
+      logger.info('Prediction worker ready');
+      return;
+    }
+
+    const pending = pendingRequests.get(message.id);
+    if (!pending) return;
+    pendingRequests.delete(message.id);
+
+    if (message.ok) {
+      pending.resolve(message);
+    } else {
+      pending.reject(new Error(`Prediction failed: ${message.error}`));
+    }
+  });
+
+  worker.stderr.on('data', (d) => {
+    logger.debug('Prediction info', { data: d.toString() });
+  });
+
+  worker.on('error', (err) => {
+    logger.error('Prediction worker error', err);
+  });
+
+  // Writing to a worker that died between requests emits EPIPE here;
+  // without a handler it would crash the main process
+  worker.stdin.on('error', (err) => {
+    logger.error('Prediction worker stdin error', err);
+    if (predictWorker === worker) {
+      predictWorker = null;
+    }
+    worker.kill();
+    rejectPendingRequests(new Error(`Prediction worker is not available: ${err.message}`));
+  });
+
+  worker.on('close', (code) => {
+    if (predictWorker === worker) {
+      predictWorker = null;
+    }
+    rejectPendingRequests(new Error(`Prediction worker exited with code ${code}`));
+  });
+
+  return worker;
+}
+
+/**
+ * Sends a single request to the prediction worker.
+ * @param {Object} request - Request payload ({ model, source, conf }).
+ * @returns {Promise<Object>} Worker response with output_path and detections.
+ */
+function sendPredictRequest(request) {
+  return new Promise((resolve, reject) => {
+    const worker = getPredictWorker();
+    const id = nextRequestId++;
+    pendingRequests.set(id, { resolve, reject });
+    worker.stdin.write(JSON.stringify({ id, ...request }) + '\n');
+  });
+}
+
+/**
+ * Stops the prediction worker if it is running.
+ */
+function stopPredictWorker() {
+  if (predictWorker) {
+    predictWorker.stdin.end();
+    predictWorker.kill();
+    predictWorker = null;
+  }
+}
+
 /**
  * Registers prediction-related IPC handlers.
  * @param {Electron.IpcMain} ipcMain - Electron IPC main instance.
  * @param {Electron.BrowserWindow} mainWindow - Main application window.
  */
 function registerPredictionHandlers(ipcMain, mainWindow) {
+  app.on('before-quit', stopPredictWorker);
+
   /**
    * Runs object detection on an image using a trained YOLO model.
    * @param {Electron.IpcMainInvokeEvent} event - The IPC event.
@@ -18,60 +135,23 @@ function registerPredictionHandlers(ipcMain, mainWindow) {
    * @returns {Promise<Object>} Result object with success, resultPath, output, and detections array.
    */
   ipcMain.handle('predict-image', async (event, { modelPath, imagePath, conf }) => {
-    return new Promise((resolve, reject) => {
-      const pythonPath = process.platform === 'win32' ? 'python' : 'python3';
-      const scriptPath = path.join(__dirname, '../../../python/predict.py');
-      const confidence = conf || 0.25;
-      
-      const pythonProcess = spawn(pythonPath, [
-        scriptPath,
-        '--model', modelPath,
-        '--source', imagePath,
-        '--conf', confidence.toString()
-      ]);
-
-      let output = '';
-      let resultPath = '';
-      let detections = [];
-
-      pythonProcess.stdout.on('data', (d) => {
-        const line = d.toString();
-        output += line;
-        
-        const markerIndex = line.indexOf('OUTPUT_PATH:');
-        if (markerIndex !== -1) {
-          const remaining = line.substring(markerIndex + 'OUTPUT_PATH:'.length);
-          resultPath = remaining.split('\n')[0].trim();
-        }
-
-        const jsonMarkerIndex = line.indexOf('JSON_OUTPUT:');
-        if (jsonMarkerIndex !== -1) {
-          const remaining = line.substring(jsonMarkerIndex + 'JSON_OUTPUT:'.length);
-          const jsonStr = remaining.split('\n')[0].trim();
-          try {
-            detections = JSON.parse(jsonStr);
-          } catch (e) {
-            logger.error('Failed to parse detection JSON', e);
-          }
-        }
-      });
-      
-      pythonProcess.stderr.on('data', (d) => {
-        logger.debug('Prediction info', { data: d });
-      });
-
-      pythonProcess.on('close', (code) => {
-        if (code === 0 && resultPath) {
-          resolve({ success: true, resultPath: resultPath, output: output, detections: detections });
-        } else {
-          if (code === 0) {
-            reject(new Error(`Prediction finished but no output path found. Output: ${output}`));
-          } else {
-            reject(new Error(`Prediction failed with code ${code}. Output: ${output}`));
-          }
-        }
-      });
+    const confidence = conf || 0.25;
+    const response = await sendPredictRequest({
+      model: modelPath,
+      source: imagePath,
+      conf: confidence
     });
+
+    if (!response.output_path) {
+      throw new Error(`Prediction finished but no output path found. Output: ${JSON.stringify(response)}`);
+    }
+
+    const detections = response.detections || [];
+    const output = detections.length > 0
+      ? detections.map(d => `Detected: ${d.class_name} (conf: ${d.confidence.toFixed(2)})`).join('\n')
+      : 'No detections found.';
+
+    return { success: true, resultPath: response.output_path, output: output, detections: detections };
   });
 }
 
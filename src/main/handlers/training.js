@@ -1,4 +1,5 @@
 const path = require('path');
+const readline = require('readline');
 const { spawn } = require('child_process');
 const fs = require('fs-extra');
 const { logger } = require('../utils/logger');
@@ -51,7 +52,10 @@ function registerTrainingHandlers(ipcMain, mainWindow) {
       const modelClassName = className || (classNamesStr.split(',')[0] || 'Unknown');
       const modelLearningPercent = learningPercent || 100;
 
-      const pythonProcess = spawn(pythonPath, [
+      // Structured JSON-lines events go over an extra pipe (fd 3); not available for Python on Windows
+      const useEventPipe = process.platform !== 'win32';
+
+      const args = [
         scriptPath,
         '--data', datasetPath,
         '--epochs', epochs.toString(),
@@ -63,7 +67,34 @@ function registerTrainingHandlers(ipcMain, mainWindow) {
         '--device', isAppleSilicon ? 'mps' : 'auto',
         '--model-class-name', modelClassName,
         '--model-learning-percent', modelLearningPercent.toString()
-      ]);
+      ];
+
+      if (useEventPipe) {
+        args.push('--events-fd', '3');
+      }
+
+      const pythonProcess = spawn(pythonPath, args, {
+        stdio: useEventPipe ? ['pipe', 'pipe', 'pipe', 'pipe'] : ['pipe', 'pipe', 'pipe']
+      });
+
+      if (useEventPipe) {
+        const events = readline.createInterface({ input: pythonProcess.stdio[3] });
+        events.on('line', (line) => {
+          try {
+            const trainingEvent = JSON.parse(line);
+            if (mainWindow) mainWindow.webContents.send('training-metrics', trainingEvent);
+            if (trainingEvent.event === 'epoch_end') {
+              logger.debug('Training epoch finished', {
+                epoch: trainingEvent.epoch,
+                epochTime: trainingEvent.epoch_time,
+                imagesPerSec: trainingEvent.images_per_sec
+              });
+            }
+          } catch (e) {
+            logger.error('Failed to parse training event', e);
+          }
+        });
+      }
 
       let output = '';
       pythonProcess.stdout.on('data', (d) => {